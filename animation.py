@@ -1,27 +1,83 @@
-import pygame
+import clock
+from bisect import bisect_right
 
 
 class AnimationSequence:
+    """ A sequence of frames, each shown for its own number of milliseconds.
+        `timing` is either the total time or one time per frame. """
+
     def __init__(self, frames, timing, loop=False):
         self.started = None
-        self.frames = frames
+        self.frames = tuple(frames)
         self.looping = loop
         if isinstance(timing, int):
             timing = _evenly_distribute(timing, len(frames))
         elif len(frames) != len(timing):
             raise ValueError()
-        self.transitions = _compute_frame_transition_times()
+        self.transitions = _compute_frame_transition_times(timing)
+        self.duration = self.transitions[-1]
 
-    def play(self):
-        self.started = pygame.time.get_ticks()
+    def play(self, now=None):
+        self.started = clock.get_ticks() if now is None else now
 
     def stop(self):
         self.started = None
 
-    def get_frame(self):
-        pass
+    def is_finished(self, now=None):
+        """ True once a one-shot sequence has shown its last frame for its full time """
+        if self.started is None or self.looping:
+            return False
+        return (clock.get_ticks() if now is None else now) - self.started >= self.duration
+
+    def get_frame(self, now=None):
+        """ The frame showing at `now` (default: the game clock), or None if stopped """
+        if self.started is None:
+            return None
+        elapsed = (clock.get_ticks() if now is None else now) - self.started
+        if self.duration <= 0:
+            return self.frames[0]
+        if self.looping:
+            elapsed %= self.duration
+        elif elapsed >= self.duration:
+            return self.frames[-1]
+        return self.frames[bisect_right(self.transitions, elapsed) - 1]
+
+
+class Animator:
+    """ Advances every playing animation from a single clock reading and
+        sets the image of the sprite each one is playing on """
 
+    def __init__(self):
+        self.playing = {}   # sprite -> AnimationSequence
 
+    def play(self, sprite, sequence, now=None):
+        sequence.play(now)
+        self.playing[sprite] = sequence
+        sprite.image = sequence.get_frame(sequence.started)
+
+    def stop(self, sprite):
+        sequence = self.playing.pop(sprite, None)
+        if sequence is not None:
+            sequence.stop()
+
+    def clear(self):
+        for sequence in self.playing.values():
+            sequence.stop()
+        self.playing.clear()
+
+    def update(self, now=None):
+        now = clock.get_ticks() if now is None else now
+        finished = None
+        for sprite, sequence in self.playing.items():
+            if sequence.is_finished(now):
+                # whoever started a one-shot decides what to show after it
+                finished = finished or []
+                finished.append(sprite)
+            else:
+                sprite.image = sequence.get_frame(now)
+        if finished:
+            for sprite in finished:
+                self.stop(sprite)
 
 
 def _evenly_distribute(total_time, elements):
@@ -39,4 +95,4 @@ def _compute_frame_transition_times(timing):
     for i in timing:
         elapsed_time += i
         result.append(elapsed_time)
-    return result
\ No newline at end of file
+    return result
@@ -0,0 +1,116 @@
+""" Sound effects and music.  Each effect is decoded once and shared; effects
+    play on a fixed pool of channels, where a sound only takes a channel
+    from one of equal or lower priority, and a group of sounds (say, NPC
+    footsteps) can be limited to a number of voices.  Music is streamed, one
+    track at a time, fading between tracks. """
+import pygame
+from os import path
+
+SFX = path.join(path.dirname(path.abspath(__file__)), 'sfx')
+FOOTSTEP = path.join(SFX, 'footstep.wav')
+DEFAULT_MUSIC = path.join(SFX, 'piano-loop.wav')
+
+
+class SoundManager:
+    def __init__(self, channels=16, fade_millis=750):
+        self.channel_count = channels
+        self.fade_millis = fade_millis
+        self.sounds = {}        # filename -> decoded Sound
+        self.channels = None    # set up once the mixer is
+        self.voices = []        # per channel: (priority, group, started) of its sound, or None
+        self.music = None       # the track streaming, or fading out
+        self.next_music = None  # the track to start once the fade out is over
+        self.plays = 0
+        self.steals = 0
+        self.drops = 0
+
+    def ready(self):
+        """ False if there is no mixer, e.g. no sound card; every call is then a no-op """
+        if not pygame.mixer.get_init():
+            return False
+        if self.channels is None:
+            pygame.mixer.set_num_channels(self.channel_count)
+            self.channels = [pygame.mixer.Channel(i) for i in range(self.channel_count)]
+            self.voices = [None] * self.channel_count
+        return True
+
+    def get(self, filename):
+        sound = self.sounds.get(filename)
+        if sound is None and self.ready():
+            sound = self.sounds[filename] = pygame.mixer.Sound(filename)
+        return sound
+
+    def play(self, filename, priority=0, group=None, limit=None, volume=1.0):
+        """ Plays an effect, unless every channel it may take (or the last
+            `limit` voices of its group) is playing something more important.
+            Returns the Channel, or None if the sound was dropped. """
+        sound = self.get(filename)
+        if sound is None:
+            return None
+        playing = [i for i, voice in enumerate(self.voices) if voice is not None and self.channels[i].get_busy()]
+        same = [i for i in playing if self.voices[i][1] == group]
+        if limit is not None and len(same) >= limit:
+            index = self._victim(same, priority)
+        else:
+            index = self._idle(playing)
+            if index is None:
+                index = self._victim(playing, priority)
+        if index is None:
+            self.drops += 1
+            return None
+        if index in playing:
+            self.steals += 1
+        channel = self.channels[index]
+        channel.play(sound)
+        channel.set_volume(volume)
+        self.voices[index] = (priority, group, pygame.time.get_ticks())
+        self.plays += 1
+        return channel
+
+    def play_music(self, filename):
+        """ Streams `filename` on a loop, fading out whatever else is playing;
+            nothing happens if it is already the track playing """
+        if not self.ready():
+            return
+        if filename == self.music and self.next_music is None and pygame.mixer.music.get_busy():
+            return
+        self.next_music = filename
+        if pygame.mixer.music.get_busy():
+            pygame.mixer.music.fadeout(self.fade_millis)
+        else:
+            self.update()
+
+    def update(self):
+        """ Starts the next track once the last one has faded out; call once a frame """
+        if self.next_music is not None and not pygame.mixer.music.get_busy():
+            pygame.mixer.music.load(self.next_music)
+            pygame.mixer.music.play(-1, fade_ms=self.fade_millis)
+            self.music, self.next_music = self.next_music, None
+
+    def counters(self):
+        mixer = pygame.mixer.get_init()
+        # decoded samples: seconds * frequency * (bytes per sample * channels)
+        per_second = mixer[0] * (abs(mixer[1]) // 8) * mixer[2] if mixer else 0
+        return {'decoded': len(self.sounds), 'plays': self.plays, 'steals': self.steals, 'drops': self.drops,
+                'kb': sum(s.get_length() for s in self.sounds.values()) * per_second / 1024}
+
+    def stats(self):
+        return "sounds: {decoded} decoded ({kb:.0f} KB), {plays} played, {steals} took a busy channel, " \
+               "{drops} dropped".format(**self.counters())
+
+    def _idle(self, playing):
+        for i in range(len(self.voices)):
+            if i not in playing:
+                return i
+        return None
+
+    def _victim(self, candidates, priority):
+        # the oldest of the least important sounds, if it matters no more than this one
+        if not candidates:
+            return None
+        index = min(candidates, key=lambda i: (self.voices[i][0], self.voices[i][2]))
+        return index if self.voices[index][0] <= priority else None
+
+
+# shared by everything that makes a noise
+sounds = SoundManager()
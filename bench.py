@@ -0,0 +1,361 @@
+""" Benchmarks map loading and scripted play sessions headlessly.
+
+    usage: python bench.py [--dirty] [--renderer texture] [--crowd N] [--save FILE] [--compare FILE] [--threshold 0.25]
+"""
+import argparse
+import crowd
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from glob import glob
+from os import path
+from encounters import EncounterMap
+from headless import HeadlessGame, PHASES
+import mapfile
+from audio import sounds
+from fonts import fonts
+from render import BACKENDS
+from state import AdventureState
+from tileset import tilesets
+from world import TiledMap, compile_tmx, map_filename
+from worlddata import NPCRecord
+
+SCRIPTS = {
+    'village-walk': [
+        ('press', 'space'),
+        ('place', 24, 6),
+        ('walk', 'down', 3), ('walk', 'right', 3), ('walk', 'up', 3), ('walk', 'left', 3),
+        ('wait', 30),
+    ],
+    'talk-to-bob': [
+        ('goto', 'VILLAGE'),
+        ('place', 25, 4),
+        ('press', 'space'),
+        ('wait', 150),
+    ],
+    'village-forest-round-trip': [
+        ('goto', 'VILLAGE'),
+        ('place', 27, 2),
+        ('walk', 'up', 2),
+        ('walk', 'left', 4), ('walk', 'right', 4),
+        ('walk', 'down', 1),
+        ('walk', 'down', 3),
+    ],
+    'idle': [
+        ('goto', 'VILLAGE'),
+        ('wait', 120),
+    ],
+}
+
+# recorded at 60 fps and replayed at each of REPLAY_FPS; any key starts the game, F5 saves, F9 loads
+REPLAY_SCRIPT = [
+    ('wait', 10),
+    ('press', 'space'),
+    ('walk', 'down', 2),
+    ('press', 'f5'),
+    ('walk', 'right', 3), ('walk', 'up', 1),
+    ('wait', 20),
+    ('press', 'f9'),
+    ('walk', 'left', 2),
+    ('press', 'space'),
+    ('wait', 60),
+]
+REPLAY_FPS = (60, 30, 20, 12)
+
+
+def bench_startup(dirty_rects, renderer='auto'):
+    """ Startup time and memory with the map states built lazily (as the game
+        starts), and eagerly (every map built up front, and drawn once) """
+    results = {}
+    for mode in ('lazy', 'eager'):
+        tracemalloc.start()
+        started = time.perf_counter()
+        game = HeadlessGame(dirty_rects, renderer=renderer)
+        try:
+            if mode == 'eager':
+                for key in game.states.map_names:
+                    state = game.states[key]
+                    game.change_state(state)
+                    state.draw()
+                game.change_state(game.states['SPLASH'])
+            elapsed = time.perf_counter() - started
+            heap = tracemalloc.get_traced_memory()[0]
+            states = game.states
+            results[mode] = {'startup_ms': elapsed * 1000, 'heap_kb': heap / 1024,
+                             'surfaces_kb': states.memory_size() / 1024,
+                             'loaded': len(states.states), 'evictions': states.evictions}
+        finally:
+            tracemalloc.stop()
+            game.close()
+    return results
+
+
+def bench_replay(script=REPLAY_SCRIPT, fps=REPLAY_FPS, renderer='auto'):
+    """ Records `script` at 60 fps, then replays the log at each of `fps` for
+        as many simulation steps.  Returns, per frame rate, the steps at which
+        states were entered and where the player and NPCs ended up """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        log = path.join(directory, 'replay.ginp')
+        save = path.join(directory, 'replay.gsav')
+        game = HeadlessGame(record=log, renderer=renderer)
+        game.saves.filename = save
+        try:
+            game.play(script)
+        finally:
+            game.close()
+        results['recorded'] = _replay_result(game, game.frames)
+        for rate in fps:
+            if path.exists(save):
+                os.remove(save)
+            game = HeadlessGame(replay=log, renderer=renderer)
+            game.saves.filename = save
+            game.fps, game.frame_millis = rate, 1000 / rate
+            try:
+                game.run_to(results['recorded']['simulated'])
+            finally:
+                game.close()
+            results['{} fps'.format(rate)] = _replay_result(game, game.frames)
+    return results
+
+
+def _replay_result(game, frames):
+    map = game.state.get_map() if game.state is not None else None
+    return {'frames': frames, 'simulated': game.simulated, 'steps': game.steps,
+            'entries': [list(entry) for entry in game.entries],
+            'positions': sorted([type(c).__name__, getattr(c, 'name', ''), int(c.position.x), int(c.position.y), c.facing]
+                                for c in (map.characters if map is not None else ()))}
+
+
+def replay_mismatches(results):
+    """ Returns a line for every replay that ended up differently from the recording """
+    recorded = results['recorded']
+    return ["replay at {}: {} {} -> {}".format(name, key, recorded[key], r[key])
+            for name, r in results.items() if name != 'recorded'
+            for key in ('simulated', 'steps', 'entries', 'positions') if r[key] != recorded[key]]
+
+
+def bench_maps(game):
+    """ Load time and memory of every map, from its artifact and from the .tmx """
+    results = {}
+    names = [path.splitext(path.basename(f))[0]
+             for f in sorted(glob(path.join(path.dirname(__file__), 'maps', '*.tmx')))]
+    for name in names:
+        filename = map_filename(name)
+        started = time.perf_counter()
+        compile_tmx(filename, game.tile_size)
+        parse_time = time.perf_counter() - started
+        tracemalloc.start()
+        started = time.perf_counter()
+        state = AdventureState(game, game.player, name, game.camera)
+        load_time = time.perf_counter() - started
+        heap = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        game.change_state(state)
+        started = time.perf_counter()
+        game.present(state.draw())
+        first_frame = time.perf_counter() - started
+        results[name] = {
+            'load_ms': load_time * 1000,
+            'parse_ms': parse_time * 1000,
+            'first_frame_ms': first_frame * 1000,
+            'heap_kb': heap / 1024,
+            'surfaces_kb': state.memory_size() / 1024,
+            'artifact': mapfile.is_current(filename, game.tile_size),
+        }
+        game.change_state(None)
+        state.unload()
+    return results
+
+
+def bench_crowd(game, count, steps=600, map_name='village', script='wander'):
+    """ Simulation time per step with `count` NPCs running `script`, moved by
+        the numpy crowd (if numpy is installed) and one at a time """
+    probe = TiledMap(map_name, game)
+    spots = [(x, y) for y in range(probe.height) for x in range(probe.width) if probe.grid.is_walkable(x, y)]
+    probe.unload()
+    npcs = [NPCRecord(None, 'npc{}'.format(i), 'p007', map_name, x, y, script)
+            for i, (x, y) in enumerate(random.Random(count).sample(spots, min(count, len(spots))))]
+    results = {}
+    enabled = crowd.enabled
+    modes = ('arrays', 'objects') if crowd.numpy is not None else ('objects',)
+    try:
+        for mode in modes:
+            crowd.enabled = mode == 'arrays'
+            map = TiledMap(map_name, game, game.player, npcs=npcs)
+            started = time.perf_counter()
+            for step in range(1, steps + 1):
+                game.sim_clock.ticks = round(step * game.step_millis)
+                map.paths.update(game.player)
+                map.actors.update()
+                if map.crowd is not None:
+                    map.crowd.update(player=game.player)
+                map.animations.update()
+            results[mode + '_step_ms'] = (time.perf_counter() - started) * 1000 / steps
+            map.unload()
+    finally:
+        crowd.enabled = enabled
+    return results
+
+
+def bench_paths(game, queries=200):
+    """ Time per A* query between random walkable tiles, and per distance field search, on every map """
+    results = {}
+    names = [path.splitext(path.basename(f))[0]
+             for f in sorted(glob(path.join(path.dirname(__file__), 'maps', '*.tmx')))]
+    for name in names:
+        map = TiledMap(name, game)
+        spots = [(x, y) for y in range(map.height) for x in range(map.width) if not map.grid.is_blocked(x, y)]
+        rng = random.Random(name)
+        paths = map.paths
+        paths.query_budget = map.width * map.height     # one whole query per step at most
+        started = time.perf_counter()
+        for _ in range(queries):
+            paths.update()
+            paths.find_path(rng.choice(spots), rng.choice(spots))
+        query_time = time.perf_counter() - started
+        field = paths.field('exits')
+        started = time.perf_counter()
+        for goal in spots[:20]:
+            field.retarget([goal])
+            field.finish()
+        results[name] = {'query_ms': query_time * 1000 / queries,
+                         'field_ms': (time.perf_counter() - started) * 1000 / min(20, len(spots))}
+        map.unload()
+    return results
+
+
+def bench_encounters(sizes=(32, 128, 512, 2048), steps=200_000):
+    """ Time per encounter roll on square maps of each size, half of them grass """
+    results = {}
+    table = {'tallgrass': [('Pidgey', 50), ('Rattata', 35), ('Spearow', 15)]}
+    for size in sizes:
+        rng = random.Random(size)
+        grass = [rng.random() < 0.5 for _ in range(size * size)]
+        encounters = EncounterMap(size, size, [('tallgrass', grass)], table, seed=size)
+        walk = [(rng.randrange(size), rng.randrange(size)) for _ in range(1000)]
+        step = encounters.step
+        started = time.perf_counter()
+        for _ in range(steps // len(walk)):
+            for x, y in walk:
+                step(x, y)
+        elapsed = time.perf_counter() - started
+        results['{0}x{0}'.format(size)] = {'step_us': elapsed * 1e6 / steps,
+                                            'encounter_rate': encounters.encounters / steps}
+    return results
+
+
+def bench_script(name, script, dirty_rects, renderer='auto'):
+    game = HeadlessGame(dirty_rects, renderer=renderer)
+    try:
+        started = time.perf_counter()
+        game.play(script)
+        elapsed = time.perf_counter() - started
+    finally:
+        game.close()
+    result = {'frames': game.frames, 'total_ms': elapsed * 1000}
+    for phase in PHASES:
+        samples = sorted(game.timings[phase])
+        if samples:
+            result[phase + '_mean_ms'] = sum(samples) * 1000 / len(samples)
+            result[phase + '_p95_ms'] = samples[int(len(samples) * 0.95)] * 1000
+    return result
+
+
+def compare(results, baseline, threshold):
+    """ Returns a line for every timing that got slower than `threshold` allows """
+    regressions = []
+    for section in ('startup', 'maps', 'scripts', 'crowd', 'paths'):
+        for name, metrics in results[section].items():
+            for metric, value in metrics.items():
+                old = baseline.get(section, {}).get(name, {}).get(metric)
+                if metric.endswith('_ms') and isinstance(old, (int, float)) and old > 0.05 \
+                        and value > old * (1 + threshold):
+                    regressions.append("{} {} {}: {:.2f} -> {:.2f}".format(section, name, metric, old, value))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="headless benchmarks")
+    parser.add_argument('--dirty', action='store_true', help="use dirty-rectangle rendering")
+    parser.add_argument('--renderer', choices=BACKENDS, default='auto', help="draw with textures or surfaces")
+    parser.add_argument('--crowd', type=int, default=300, help="wandering NPCs in the crowd benchmark")
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="report regressions against this JSON file")
+    parser.add_argument('--threshold', type=float, default=0.25, help="allowed slowdown, as a fraction")
+    args = parser.parse_args(argv)
+
+    game = HeadlessGame(args.dirty, renderer=args.renderer)
+    try:
+        results = {'startup': bench_startup(args.dirty, args.renderer), 'maps': bench_maps(game), 'scripts': {}}
+        results['crowd'] = {'{} npcs'.format(args.crowd): bench_crowd(game, args.crowd),
+                            '{} followers'.format(args.crowd): bench_crowd(game, args.crowd, script='follow')}
+        results['paths'] = bench_paths(game)
+        results['encounters'] = bench_encounters()
+    finally:
+        game.close()
+    results['replay'] = bench_replay(renderer=args.renderer)
+    print("{:<12} {:>9} {:>9} {:>11} {:>7} {:>9}".format('startup', 'ms', 'heap KB', 'surface KB', 'loaded', 'evicted'))
+    for name, r in results['startup'].items():
+        print("{:<12} {:9.1f} {:9.0f} {:11.0f} {:7d} {:9d}".format(
+            name, r['startup_ms'], r['heap_kb'], r['surfaces_kb'], r['loaded'], r['evictions']))
+    print()
+    print("{:<12} {:>9} {:>9} {:>9} {:>9} {:>11}  {}".format(
+        'map', 'load ms', 'parse ms', 'frame ms', 'heap KB', 'surface KB', 'from'))
+    for name, r in results['maps'].items():
+        print("{:<12} {:9.1f} {:9.1f} {:9.1f} {:9.0f} {:11.0f}  {}".format(
+            name, r['load_ms'], r['parse_ms'], r['first_frame_ms'], r['heap_kb'], r['surfaces_kb'],
+            '.gmap' if r['artifact'] else '.tmx'))
+
+    for name, r in results['crowd'].items():
+        print("\n{}: {}".format(name, ", ".join("{} {:.3f}".format(k, v) for k, v in r.items())))
+
+    print("\n{:<12} {:>9} {:>9}".format('paths', 'query ms', 'field ms'))
+    for name, r in results['paths'].items():
+        print("{:<12} {:9.3f} {:9.3f}".format(name, r['query_ms'], r['field_ms']))
+
+    print("\n{:<12} {:>9} {:>10}".format('encounters', 'step us', 'rate'))
+    for name, r in results['encounters'].items():
+        print("{:<12} {:9.3f} {:10.3f}".format(name, r['step_us'], r['encounter_rate']))
+
+    print("\n{:<12} {:>6} {:>9} {:>6}  {}".format('replay', 'frames', 'simulated', 'steps', 'entered at'))
+    for name, r in results['replay'].items():
+        print("{:<12} {:6d} {:9d} {:6d}  {}".format(name, r['frames'], r['simulated'], r['steps'],
+                                                     ", ".join("{} {}".format(k, s) for s, k in r['entries'])))
+    mismatches = replay_mismatches(results['replay'])
+    for line in mismatches:
+        print("MISMATCH", line)
+
+    print()
+    print("{:<26} {:>6}".format('script', 'frames') + ''.join(" {:>14}".format(p + ' ms') for p in PHASES))
+    for name, script in SCRIPTS.items():
+        r = results['scripts'][name] = bench_script(name, script, args.dirty, args.renderer)
+        print("{:<26} {:6d}".format(name, r['frames']) + ''.join(
+            " {:6.3f} /{:6.3f}".format(r.get(p + '_mean_ms', 0), r.get(p + '_p95_ms', 0)) for p in PHASES))
+    print("(mean / p95 per frame)")
+
+    # the caches are shared by every game in this process, so these cover the whole run
+    print()
+    results['caches'] = {}
+    for name, cache in (('tilesets', tilesets), ('fonts', fonts), ('sounds', sounds)):
+        results['caches'][name] = cache.counters()
+        print(cache.stats())
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for line in regressions:
+            print("REGRESSION", line)
+        return 1 if regressions or mismatches else 0
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
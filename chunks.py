@@ -0,0 +1,121 @@
+import pygame
+from collections import OrderedDict
+from profiler import profiler
+
+CHUNK_TILES = 8     # chunks are CHUNK_TILES x CHUNK_TILES tiles
+
+
+class TileLayerSource:
+    """ Renders parts of a stack of tile layers from (shared) tile surfaces """
+
+    def __init__(self, layers, width, height, tiles, tile_size, alpha):
+        self.layers = layers    # row-major GID sequences, bottom layer first
+        self.width = width      # in tiles
+        self.height = height    # in tiles
+        self.tiles = tiles      # GID -> tile surface, already at tile_size
+        self.tile_size = (int(tile_size[0]), int(tile_size[1]))
+        self.alpha = alpha
+
+    def get_size(self):
+        return self.width * self.tile_size[0], self.height * self.tile_size[1]
+
+    def render(self, rect):
+        tw, th = self.tile_size
+        if self.alpha:
+            surface = pygame.Surface(rect.size, pygame.SRCALPHA, 32)
+        else:
+            surface = pygame.Surface(rect.size)
+        if pygame.display.get_surface() is not None:
+            # without a display (in a build worker) the pixels are only going to be read back
+            surface = surface.convert_alpha() if self.alpha else surface.convert()
+        x0, y0 = rect.left // tw, rect.top // th
+        x1, y1 = min(self.width, -(-rect.right // tw)), min(self.height, -(-rect.bottom // th))
+        tiles = self.tiles
+        for layer in self.layers:
+            for y in range(y0, y1):
+                row = y * self.width
+                for x in range(x0, x1):
+                    tile = tiles.get(layer[row + x])
+                    if tile is not None:
+                        surface.blit(tile, (x * tw - rect.left, y * th - rect.top))
+        return surface
+
+
+class PixelBufferSource:
+    """ Renders parts of a map-sized raw pixel buffer, e.g. one memory-mapped from a .gmap file """
+
+    def __init__(self, pixels, size, format):
+        self.pixels = pixels
+        self.size = size
+        self.format = format    # 'RGB' or 'RGBA'
+        self.alpha = format == 'RGBA'
+
+    def get_size(self):
+        return self.size
+
+    def render(self, rect):
+        bpp = len(self.format)
+        stride = self.size[0] * bpp
+        left, right = rect.left * bpp, rect.right * bpp
+        rows = [self.pixels[y * stride + left:y * stride + right] for y in range(rect.top, rect.bottom)]
+        surface = pygame.image.frombuffer(b''.join(rows), rect.size, self.format)
+        return surface.convert_alpha() if self.alpha else surface.convert()
+
+
+class ChunkedLayer:
+    """ A map-sized image that is rendered in fixed-size chunks as the camera
+        gets to them.  Only the most recently drawn chunks are kept. """
+
+    def __init__(self, source, tile_size, capacity=32):
+        self.source = source
+        self.width, self.height = source.get_size()
+        self.chunk_width = CHUNK_TILES * int(tile_size[0])
+        self.chunk_height = CHUNK_TILES * int(tile_size[1])
+        self.capacity = capacity
+        self.chunks = OrderedDict()     # (column, row) -> surface, or None if fully transparent
+
+    def get_rect(self):
+        return pygame.Rect(0, 0, self.width, self.height)
+
+    def get_chunk(self, column, row):
+        key = (column, row)
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+        rect = pygame.Rect(column * self.chunk_width, row * self.chunk_height, self.chunk_width, self.chunk_height)
+        with profiler.scope('chunk render'):
+            chunk = self.source.render(rect.clip(self.get_rect()))
+        if self.source.alpha and chunk.get_bounding_rect().width == 0:
+            chunk = None
+        self.chunks[key] = chunk
+        while len(self.chunks) > self.capacity:
+            self.chunks.popitem(last=False)
+        return chunk
+
+    def draw(self, screen, camera):
+        """ Blits the chunks that intersect the screen's clip area; `camera` is a Camera """
+        offset = camera.apply(self.get_rect())
+        if offset is None:
+            return
+        view = screen.get_clip().move(-offset.left, -offset.top)
+        for column, row in self.chunks_in(view):
+            chunk = self.get_chunk(column, row)
+            if chunk is not None:
+                screen.blit(chunk, (offset.left + column * self.chunk_width, offset.top + row * self.chunk_height))
+
+    def chunks_in(self, rect):
+        """ The (column, row) of every chunk that `rect` (in map pixels) touches """
+        view = rect.clip(self.get_rect())
+        return [(column, row)
+                for row in range(view.top // self.chunk_height, -(-view.bottom // self.chunk_height))
+                for column in range(view.left // self.chunk_width, -(-view.right // self.chunk_width))]
+
+    def memory_size(self):
+        return sum(c.get_bytesize() * c.get_width() * c.get_height() for c in self.chunks.values() if c is not None)
+
+
+def split_layers(layers):
+    """ Splits (name, gids) layers into the ones drawn under and over the characters """
+    names = [name for name, _ in layers]
+    split = names.index('collision') + 1 if 'collision' in names else len(layers)
+    return [gids for _, gids in layers[:split]], [gids for _, gids in layers[split:]]
@@ -0,0 +1,28 @@
+import pygame
+
+
+class VirtualClock:
+    """ A millisecond clock that only moves when it is told to """
+
+    def __init__(self, ticks=0):
+        self.ticks = ticks
+
+    def get_ticks(self):
+        return self.ticks
+
+    def advance(self, millis):
+        self.ticks += millis
+
+
+_source = None
+
+
+def get_ticks():
+    """ Milliseconds of game time; pygame's clock unless another one is in use """
+    return pygame.time.get_ticks() if _source is None else _source.get_ticks()
+
+
+def use(source):
+    """ Makes `source` (anything with get_ticks(), or None for pygame's) the game clock """
+    global _source
+    _source = source
@@ -0,0 +1,91 @@
+""" Compiles the maps in maps/*.tmx into the .gmap artifacts that TiledMap
+    memory-maps at load time, on a pool of worker processes.  Maps whose
+    artifacts are newer than all of their inputs are skipped.
+
+    usage: python compile_maps.py [--force] [--jobs N] [--tile-size N] [map ...]
+"""
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+import argparse
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+from os import path
+import mapfile
+from tileset import tilesets
+from world import map_filename, parse_tmx, resolve_tiles
+
+PHASES = ('parse', 'tiles', 'composite', 'write')
+
+
+def build(name, tile_size):
+    """ Compiles one map, without a display; returns its timings and artifact size """
+    timings = {}
+    started = time.perf_counter()
+    decodes = tilesets.decodes
+    filename = map_filename(name)
+    data = parse_tmx(filename, tile_size)
+    timings['parse'] = time.perf_counter() - started
+    for _ in resolve_tiles(data):
+        pass
+    timings['tiles'] = time.perf_counter() - started - timings['parse']
+    mark = time.perf_counter()
+    pixels = mapfile.composite(data)
+    timings['composite'] = time.perf_counter() - mark
+    mark = time.perf_counter()
+    target = mapfile.save(data, filename, pixels)
+    timings['write'] = time.perf_counter() - mark
+    # atlases decoded by this map (rather than an earlier one in the same worker)
+    return name, timings, path.getsize(target), tilesets.decodes - decodes, os.getpid()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="compile .tmx maps into .gmap artifacts")
+    parser.add_argument('maps', nargs='*', help="map names (default: every map in maps/)")
+    parser.add_argument('--force', '-f', action='store_true', help="rebuild up to date artifacts too")
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument('--tile-size', type=int, default=32, help="rendered tile size in pixels")
+    args = parser.parse_args(argv)
+    names = args.maps or [path.splitext(path.basename(f))[0]
+                          for f in sorted(glob(path.join(path.dirname(__file__), 'maps', '*.tmx')))]
+    tile_size = (args.tile_size, args.tile_size)
+    stale = []
+    for name in names:
+        if not args.force and mapfile.is_current(map_filename(name), tile_size):
+            print("{:<12} up to date".format(name))
+        else:
+            stale.append(name)
+    if not stale:
+        return 0
+    #
+    # the biggest maps first, so that no worker is left with one at the end
+    stale.sort(key=lambda n: path.getsize(map_filename(n)), reverse=True)
+    started = time.perf_counter()
+    results = []
+    failed = 0
+    with ProcessPoolExecutor(max_workers=max(1, min(args.jobs, len(stale)))) as pool:
+        jobs = {pool.submit(build, name, tile_size): name for name in stale}
+        for job in as_completed(jobs):
+            try:
+                results.append(job.result())
+            except Exception as e:
+                failed += 1
+                print("{:<12} FAILED: {}".format(jobs[job], e))
+    elapsed = time.perf_counter() - started
+
+    print("{:<12}".format('map') + ''.join("{:>13}".format(p + ' ms') for p in PHASES)
+          + "{:>11} {:>10} {:>8} {:>7}".format('total ms', 'KB', 'atlases', 'worker'))
+    busy = 0
+    for name, timings, size, decodes, worker in sorted(results):
+        total = sum(timings.values())
+        busy += total
+        print("{:<12}".format(name) + ''.join("{:13.1f}".format(timings[p] * 1000) for p in PHASES)
+              + "{:11.1f} {:10.1f} {:8d} {:7d}".format(total * 1000, size / 1024, decodes, worker))
+    print("{} maps in {:.1f} ms on {} workers ({:.1f} ms of work, {:.1f}x)".format(
+        len(results), elapsed * 1000, min(args.jobs, len(stale)), busy * 1000, busy / max(elapsed, 1e-9)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
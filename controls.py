@@ -0,0 +1,140 @@
+""" Turns keyboard and window events into intents, and records them to (or
+    replays them from) a log.
+
+    Game intents (moving, interacting and any other key) are stamped with
+    the simulation step they take effect on, counted from startup so that
+    loading a save does not move it, and released by Game.advance()
+    one step at a time, so a replay reproduces a session step for step
+    whatever the frame rate; the running state's update() finds a step's
+    intents in `released`.  Quitting is not a game intent: events() gets it
+    as soon as it is polled.
+
+    A log is b'GINP', a version (u16), then a record per intent:
+    step (u32), kind (u8), argument (i32).
+"""
+import pygame
+import struct
+from collections import deque
+
+MAGIC = b'GINP'
+VERSION = 2
+_HEADER = struct.Struct('<4sH')
+_RECORD = struct.Struct('<IBi')
+
+MOVE, INTERACT, QUIT, KEY = 1, 2, 3, 4
+DIRECTIONS = (None, 'down', 'up', 'left', 'right')     # MOVE arguments
+GAME_INTENTS = (MOVE, INTERACT, KEY)
+
+KEY_DIRECTIONS = {
+    pygame.K_DOWN: 'down', pygame.K_s: 'down',
+    pygame.K_UP: 'up', pygame.K_w: 'up',
+    pygame.K_LEFT: 'left', pygame.K_a: 'left',
+    pygame.K_RIGHT: 'right', pygame.K_d: 'right',
+}
+INTERACT_KEYS = (pygame.K_SPACE,)
+QUIT_KEYS = (pygame.K_ESCAPE,)
+
+
+class InputLayer:
+    def __init__(self, game):
+        self.game = game
+        self.held = []              # direction keys held down, most recent last
+        self.pending = deque()      # (step, kind, argument) not yet released
+        self.direction = None       # the direction the player is being moved in, if any
+        self.intents = deque()      # released interactions not yet taken
+        self.released = []          # (kind, argument) of the game intents the current step released
+        self.recording = None       # open log file
+        self.replay = None          # (step, kind, argument) of the logged intents not yet polled
+
+    def poll(self):
+        """ Handles this frame's events, queueing the game intents for the next
+            simulation step.  Returns the (kind, argument) of every intent found. """
+        step = self.game.simulated + 1
+        found = []
+        for event in pygame.event.get():
+            if self.replay is not None and event.type not in (pygame.QUIT, pygame.WINDOWCLOSE):
+                continue    # the log is in control
+            found.extend(self._translate(event))
+        for kind, argument in found:
+            if self.recording is not None:
+                self.recording.write(_RECORD.pack(step, kind, argument))
+            if kind in GAME_INTENTS:
+                self.pending.append((step, kind, argument))
+        if self.replay is not None:
+            # (the log's game intents are pending already, stamped with their own steps)
+            while self.replay and self.replay[0][0] <= step:
+                found.append(self.replay.popleft()[1:])
+            if not self.replay and not self.pending:
+                self.replay = None
+                print("replay finished at step {}".format(step))
+        return found
+
+    def step(self, step):
+        """ Releases the game intents stamped for `step`; Game.advance() calls it before each update """
+        self.released = []
+        while self.pending and self.pending[0][0] <= step:
+            _, kind, argument = self.pending.popleft()
+            self.released.append((kind, argument))
+            if kind == MOVE:
+                self.direction = DIRECTIONS[argument]
+            elif kind == INTERACT:
+                self.intents.append(kind)
+
+    def take(self, kind):
+        """ True (once) if an intent of `kind` was released """
+        if kind in self.intents:
+            self.intents.remove(kind)
+            return True
+        return False
+
+    def forget(self):
+        """ Drops the released intents no one took, e.g. the key that left the
+            splash screen, so they do not carry over into the next state """
+        self.intents.clear()
+
+    def record(self, filename):
+        self.recording = open(filename, 'wb')
+        self.recording.write(_HEADER.pack(MAGIC, VERSION))
+
+    def play(self, filename):
+        """ Takes the intents from a log instead of the keyboard """
+        with open(filename, 'rb') as f:
+            data = f.read()
+        magic, version = _HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('not a version {} input log'.format(VERSION))
+        records = list(_RECORD.iter_unpack(data[_HEADER.size:]))
+        self.pending = deque(r for r in records if r[1] in GAME_INTENTS)
+        self.replay = deque(records)
+
+    def close(self):
+        if self.recording is not None:
+            self.recording.close()
+            self.recording = None
+
+    def _translate(self, event):
+        if event.type in (pygame.QUIT, pygame.WINDOWCLOSE):
+            # (the texture renderer's window is not the display's, so closing it is not a QUIT)
+            return [(QUIT, 0)]
+        if event.type == pygame.KEYDOWN:
+            if event.key in KEY_DIRECTIONS:
+                return self._hold(event.key, True)
+            if event.key in INTERACT_KEYS:
+                return [(INTERACT, 0)]
+            if event.key in QUIT_KEYS:
+                return [(QUIT, 0)]
+            return [(KEY, event.key)]
+        if event.type == pygame.KEYUP and event.key in KEY_DIRECTIONS:
+            return self._hold(event.key, False)
+        return []
+
+    def _hold(self, key, down):
+        before = self.held[-1] if self.held else None
+        if key in self.held:
+            self.held.remove(key)
+        if down:
+            self.held.append(key)
+        direction = KEY_DIRECTIONS[self.held[-1]] if self.held else None
+        if direction == (KEY_DIRECTIONS[before] if before is not None else None):
+            return []
+        return [(MOVE, DIRECTIONS.index(direction))]
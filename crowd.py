@@ -0,0 +1,155 @@
+""" Moves all of a map's NPCs in one go: their positions, targets, directions
+    and move start times live in numpy arrays, and each simulation step
+    advances every NPC (and checks every new move against the map's grid)
+    with a handful of array operations.
+
+    NPCs that 'follow' the player all read the player's distance field (see
+    paths.py) at once, and step to their closest neighbouring tile.
+
+    numpy is optional.  Without it, TiledMap leaves each NPC to update itself.
+"""
+import clock
+from profiler import profiler
+from paths import UNREACHABLE
+from sprites import DIRECTIONS, Vector, WANDER_CHANCE
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FACINGS = ('down', 'up', 'left', 'right')
+enabled = numpy is not None     # False updates NPCs one at a time, as Character.update() does
+SCRIPTS = (None, 'wander', 'follow')    # the NPCs a crowd can move; TiledMap leaves the others to themselves
+
+
+class NPCCrowd:
+    def __init__(self, map, npcs, seed=0):
+        self.map = map
+        self.sprites = list(npcs)
+        self.tile_size = (map.tile_size.x, map.tile_size.y)
+        count = len(self.sprites)
+        self.steps = numpy.array([(DIRECTIONS[f].x, DIRECTIONS[f].y) for f in FACINGS], numpy.int32)
+        self.position = numpy.array([(s.position.x, s.position.y) for s in self.sprites], numpy.int32).reshape(count, 2)
+        self.target = self.position.copy()
+        self.direction = numpy.zeros(count, numpy.int8)     # index into FACINGS
+        self.started = numpy.zeros(count, numpy.int64)      # in game clock milliseconds
+        self.millis = numpy.array([s.millis_per_grid_sq for s in self.sprites], numpy.float64)
+        self.moving = numpy.zeros(count, bool)
+        self.changed = numpy.zeros(count, bool)             # whose rects the last step moved
+        self.wanders = numpy.array([s.script == 'wander' for s in self.sprites], bool)
+        self.follows = numpy.array([s.script == 'follow' for s in self.sprites], bool)
+        self.rng = numpy.random.default_rng(seed)
+        #
+        # views of the grid's bytearrays, so occupying a tile here is seen everywhere
+        self.blocked = numpy.frombuffer(map.grid.blocked, numpy.uint8)
+        self.occupied = numpy.frombuffer(map.grid.occupied, numpy.uint8)
+
+    def __len__(self):
+        return len(self.sprites)
+
+    def place(self, sprite):
+        """ Picks up a new position that was given to a standing sprite from outside the crowd """
+        i = self.sprites.index(sprite)
+        self.position[i] = self.target[i] = (int(sprite.position.x), int(sprite.position.y))
+        self.changed[i] = True
+
+    def update(self, now=None, player=None):
+        """ One simulation step for every NPC, like Character.update() """
+        if not self.sprites:
+            return
+        now = clock.get_ticks() if now is None else now
+        moving = self.moving
+        for i in numpy.flatnonzero(moving | self.changed).tolist():
+            sprite = self.sprites[i]
+            sprite.previous_rect = sprite.rect.copy()
+        self.changed = moving.copy()
+        if moving.any():
+            with profiler.scope('crowd move'):
+                self._advance(now)
+        if self.wanders.any():
+            with profiler.scope('crowd collision'):
+                self._wander(now, player)
+        if self.follows.any():
+            with profiler.scope('crowd follow'):
+                self._follow(now, player)
+
+    def _advance(self, now):
+        moving = self.moving
+        done = numpy.minimum((now - self.started) / self.millis, 1.0)
+        offset = self.steps[self.direction] * numpy.where(moving, done, 0.0)[:, None]
+        tw, th = self.tile_size
+        left = ((self.position[:, 0] + offset[:, 0]) * tw).tolist()
+        bottom = ((self.position[:, 1] + offset[:, 1] + 1) * th).tolist()
+        arrived = moving & (done >= 1.0)
+        for i in numpy.flatnonzero(moving & ~arrived).tolist():
+            self.sprites[i].rect.bottomleft = (left[i], bottom[i])
+        if arrived.any():
+            # leave the tiles behind all at once
+            behind = self.position[arrived]
+            numpy.subtract.at(self.occupied, behind[:, 1] * self.map.width + behind[:, 0], 1)
+            self.position[arrived] = self.target[arrived]
+            moving[arrived] = False
+            for i in numpy.flatnonzero(arrived).tolist():
+                sprite = self.sprites[i]
+                sprite.move_rect(Vector(int(self.position[i, 0]), int(self.position[i, 1])))
+                sprite.is_moving = False
+                sprite.image = sprite.standing_image()
+
+    def _wander(self, now, player):
+        starting = numpy.flatnonzero(self.wanders & ~self.moving & (self.rng.random(len(self.sprites)) < WANDER_CHANCE))
+        if not len(starting):
+            return
+        self._start(starting, self.rng.integers(0, len(FACINGS), len(starting)), now, player)
+
+    def _follow(self, now, player):
+        standing = numpy.flatnonzero(self.follows & ~self.moving)
+        if not len(standing):
+            return
+        distance = numpy.frombuffer(self.map.paths.field('player').distance, numpy.int32)
+        width, height = self.map.width, self.map.height
+        here = self.position[standing]
+        # the distance of each NPC's tile and of its four neighbours, in FACINGS order
+        x = here[:, 0, None] + self.steps[None, :, 0]
+        y = here[:, 1, None] + self.steps[None, :, 1]
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        around = numpy.where(inside, distance[numpy.where(inside, y * width + x, 0)], UNREACHABLE)
+        direction = around.argmin(axis=1)
+        current = distance[here[:, 1] * width + here[:, 0]]
+        # (stopping next to the player, rather than at it)
+        closer = (around[numpy.arange(len(standing)), direction] < current) & (current > 1)
+        self._start(standing[closer], direction[closer], now, player)
+
+    def _start(self, starting, direction, now, player):
+        # sets off the NPCs `starting` in the FACINGS `direction`, where the tiles are free
+        if not len(starting):
+            return
+        target = self.position[starting] + self.steps[direction]
+        x, y = target[:, 0], target[:, 1]
+        width, height = self.map.width, self.map.height
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        tiles = numpy.where(inside, y * width + x, 0)
+        free = inside & (self.blocked[tiles] == 0) & (self.occupied[tiles] == 0)
+        if player is not None:
+            for tile in (player.position, player.current_move):
+                free &= (x != int(tile.x)) | (y != int(tile.y))
+        # NPCs setting off for the same tile: the first one gets it
+        _, first = numpy.unique(numpy.where(free, tiles, -1 - numpy.arange(len(tiles))), return_index=True)
+        chosen = first[free[first]]
+        if not len(chosen):
+            return
+        numpy.add.at(self.occupied, tiles[chosen], 1)
+        movers = starting[chosen]
+        self.target[movers] = target[chosen]
+        self.direction[movers] = direction[chosen]
+        self.started[movers] = now
+        self.moving[movers] = True
+        for i, d in zip(movers.tolist(), direction[chosen].tolist()):
+            sprite = self.sprites[i]
+            sprite.facing = FACINGS[d]
+            sprite.started_moving = now
+            sprite.current_move = Vector(int(self.target[i, 0]), int(self.target[i, 1]))
+            sprite.is_moving = True
+            sprite.reindex_move()
+            self.map.animations.play(sprite, sprite.walks[sprite.facing], now)
+            sprite.play_footstep()
@@ -0,0 +1,66 @@
+""" Wild encounters in tall grass and other hiding spots.  When a map is
+    built, the tile layers that have a spawn table in the world data store
+    are flattened into a region mask (a byte per tile: which layer's table
+    applies there, or 0) and each table into cumulative weights, so a step
+    costs one lookup, and a couple of random numbers on encounter tiles,
+    however big the map is.
+"""
+import random
+from bisect import bisect_right
+from itertools import accumulate
+
+ENCOUNTER_CHANCE = 1 / 10   # per step onto an encounter tile
+
+
+class SpawnTable:
+    """ Picks a creature with a probability proportional to its weight """
+
+    def __init__(self, entries):
+        self.creatures = [creature for creature, _ in entries]
+        self.cumulative = list(accumulate(weight for _, weight in entries))
+
+    def choose(self, rng):
+        return self.creatures[bisect_right(self.cumulative, rng.random() * self.cumulative[-1])]
+
+
+class EncounterMap:
+    def __init__(self, width, height, layers, tables, seed=0, chance=ENCOUNTER_CHANCE):
+        self.width = width
+        self.height = height
+        self.chance = chance
+        self.mask = bytearray(width * height)
+        self.regions = [None]       # region number -> (layer name, SpawnTable); 0 is no region
+        for name, gids in layers:
+            entries = tables.get(name)
+            if not entries or len(self.regions) > 255:
+                continue
+            region = len(self.regions)
+            self.regions.append((name, SpawnTable(entries)))
+            mask = self.mask
+            for i, gid in enumerate(gids):
+                if gid:
+                    mask[i] = region    # a later layer wins where they overlap
+        self.rng = random.Random(seed)
+        self.encounters = 0
+
+    def memory_size(self):
+        return len(self.mask)
+
+    def region_at(self, x, y):
+        """ The name of the encounter layer at tile (x, y), or None """
+        x, y = int(x), int(y)
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        region = self.mask[y * self.width + x]
+        return self.regions[region][0] if region else None
+
+    def step(self, x, y):
+        """ Rolls for an encounter on stepping onto tile (x, y); returns the creature, or None """
+        x, y = int(x), int(y)
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return None
+        region = self.mask[y * self.width + x]
+        if not region or self.rng.random() >= self.chance:
+            return None
+        self.encounters += 1
+        return self.regions[region][1].choose(self.rng)
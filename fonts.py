@@ -0,0 +1,47 @@
+import pygame
+from collections import OrderedDict
+
+
+class FontPool:
+    """ Shares fonts by (name, size, bold) and keeps the most recently
+        rendered text surfaces, so the same text is never rasterized twice """
+
+    def __init__(self, capacity=256):
+        self.fonts = {}
+        self.surfaces = OrderedDict()   # (text, font, color, antialias) -> surface
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+
+    def get_font(self, name, size, bold=False):
+        key = (name, size, bold)
+        font = self.fonts.get(key)
+        if font is None:
+            font = self.fonts[key] = pygame.font.SysFont(name, size, bold)
+        return font
+
+    def render(self, text, font, color, antialias=True):
+        """ Renders `text` in `font`, a (name, size, bold) tuple; the surface is shared, don't draw on it """
+        key = (text, font, tuple(color), antialias)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            self.misses += 1
+            surface = self.get_font(*font).render(text, antialias, color)
+            self.surfaces[key] = surface
+            if len(self.surfaces) > self.capacity:
+                self.surfaces.popitem(last=False)
+        else:
+            self.hits += 1
+            self.surfaces.move_to_end(key)
+        return surface
+
+    def counters(self):
+        return {'fonts': len(self.fonts), 'cached': len(self.surfaces), 'hits': self.hits, 'misses': self.misses,
+                'kb': sum(s.get_bytesize() * s.get_width() * s.get_height() for s in self.surfaces.values()) / 1024}
+
+    def stats(self):
+        return "fonts: {fonts} loaded; text: {cached} cached ({kb:.0f} KB), {hits} hits, {misses} misses".format(
+            **self.counters())
+
+
+fonts = FontPool()
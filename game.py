@@ -1,48 +1,142 @@
 import pygame
+import clock
+import time
+from audio import sounds
+from fonts import fonts
+from controls import InputLayer
 from os import path
+from preload import MapPreloader
+from profiler import profiler
+from render import create_renderer
+from savegame import SnapshotManager
+from tileset import tilesets
 from state import *
 from world import Camera
 
 
 class Game:
-    def __init__(self):
+    def __init__(self, dirty_rects=False, record=None, replay=None, renderer='auto'):
+        started = time.perf_counter()
         self.title = "PockétMonsters: Gamboge"
         self.display_width = 500   # 16 * 64 or 32 * 32 or 64 * 16
         self.display_height = 500   # 16 * 48 or 32 * 24 or 64 * 12
         self.tile_size = Vector(32, 32)
-        self.fps = 60
+        self.fps = 60                   # frames drawn per second, at most
+        self.updates_per_second = 60    # fixed simulation steps per second
+        self.max_steps_per_frame = 5    # simulation steps before a frame gets drawn anyway
+        self.max_frame_skip = 2         # frames in a row that may be skipped to catch up
         #
-        # create screen
-        self.screen = pygame.display.set_mode((self.display_width, self.display_height))
-        pygame.display.set_caption(self.title)
+        # create screen, and what draws on it: GPU textures or software surfaces
+        self.screen, self.renderer = create_renderer((self.display_width, self.display_height), self.title, renderer)
+        self.dirty_rects = dirty_rects and self.renderer.dirty_rects  # only update the parts of the screen that changed
         #
-        # clock
+        # clocks: real time paces the frames, simulation time only moves in fixed steps
         self.clock = pygame.time.Clock()
         self.delta_t = 0
+        self.step_millis = 1000 / self.updates_per_second
+        self.steps = 0          # the simulation step the game is on (loading a save moves it)
+        self.simulated = 0      # simulation steps run since startup
+        self.lag = 0
+        self.skipped = 0
+        self.overlay_rect = None
+        self.sim_clock = clock.VirtualClock()
+        clock.use(self.sim_clock)
+        #
+        # intents from the keyboard, or from a recording of an earlier session
+        self.input = InputLayer(self)
+        if replay:
+            self.input.play(replay)
+        if record:
+            self.input.record(record)
         #
         # camera and messages
+        self.state = None
         self.camera = Camera(self.screen)
         self.messages = MessageBox()
         self.player = Player(self, self.tile_size)
         #
-        # game states
-        self.states = {
-            'SPLASH': SplashState(self),
-            'VILLAGE': AdventureState(self, self.player, 'village', self.camera),
-            'FOREST': AdventureState(self, self.player, 'forest', self.camera),
-            'QUITTING': None,
-        }
+        # game states, built on first use
+        self.states = StateRegistry(self)
+        self.states.register('SPLASH', lambda: SplashState(self))
+        self.states.register_maps(path.join(path.dirname(__file__), 'maps'))
+        self.states.register('QUITTING', lambda: None)
+        self.preloader = MapPreloader(self)
+        self.saves = SnapshotManager(self)
         self.state = self.states['SPLASH']
+        self.startup_time = time.perf_counter() - started    # see StateRegistry.report()
 
     def run(self):
+        frames = 0
+        started, cpu_started = time.perf_counter(), time.process_time()
         while self.state is not None:
-            self.delta_t = self.clock.tick(self.fps) / 1000.0
+            millis = self.clock.tick(self.fps)
+            self.delta_t = millis / 1000.0
+            with profiler.scope('update'):
+                alpha = self.advance(millis)
+            if self.state is None:
+                break
+            self.preloader.update()
+            sounds.update()
+            if self.lag >= self.step_millis and self.skipped < self.max_frame_skip:
+                self.skipped += 1   # still behind: spend this frame on the simulation
+            else:
+                self.skipped = 0
+                with profiler.scope('draw'):
+                    dirty = self.draw(alpha)
+                with profiler.scope('flip'):
+                    self.present(dirty)
+            with profiler.scope('events'):
+                self.state.events()
+            frames += 1
+        self.preloader.close()
+        self.saves.close()
+        self.input.close()
+        elapsed, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+        print("{} frames, {:.1f} FPS, {:.2f} ms CPU per frame ({} renderer, dirty rectangles {})".format(
+            frames, frames / max(elapsed, 1e-9), cpu * 1000 / max(frames, 1), self.renderer.name,
+            'on' if self.dirty_rects else 'off'))
+        print(self.states.report())
+        for stats in (self.renderer, tilesets, fonts, sounds):
+            print(stats.stats())
+
+    def advance(self, millis):
+        """ Runs the fixed simulation steps that `millis` of real time call for.
+            Returns how far (0..1) the simulation is into the next step. """
+        self.lag = min(self.lag + millis, self.step_millis * self.max_steps_per_frame * (self.max_frame_skip + 1))
+        steps = 0
+        while self.lag >= self.step_millis and steps < self.max_steps_per_frame and self.state is not None:
+            self.steps += 1
+            self.simulated += 1
+            self.sim_clock.ticks = round(self.steps * self.step_millis)
+            self.input.step(self.simulated)
             self.state.update()
-            self.state.draw()
-            pygame.display.flip()
-            self.state.events()
+            if self.state is not None:
+                self.saves.update()
+            self.lag -= self.step_millis
+            steps += 1
+        return min(self.lag / self.step_millis, 1.0)
+
+    def draw(self, alpha):
+        """ Draws the current state and the profiler overlay over it """
+        overlay = profiler.overlay_rect(self.clock.get_fps())
+        if overlay != self.overlay_rect:
+            # uncover whatever a differently sized (or hidden) overlay was hiding, in this frame
+            self.state.invalidate([r for r in (self.overlay_rect, overlay) if r is not None])
+            self.overlay_rect = overlay
+        dirty = self.state.draw(alpha)
+        profiler.draw(self.renderer)
+        if overlay is not None and dirty is not None:
+            dirty.append(overlay)
+        return dirty
+
+    def present(self, dirty):
+        """ Shows the frame that was just drawn; `dirty` is what State.draw() returned """
+        self.renderer.present(dirty if self.dirty_rects else None)
 
     def change_state(self, state):
         self.state = state
+        self.input.forget()
         if state is not None:
             self.camera.set_map(state.get_map())
+            state.enter()
+            state.invalidate()
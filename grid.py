@@ -0,0 +1,37 @@
+class CollisionGrid:
+    """ Walkability of every tile in a map: the static collision layer plus
+        a count of the solid characters standing on (or moving into) a tile """
+
+    def __init__(self, width, height, blocked=None):
+        self.width = width
+        self.height = height
+        self.blocked = bytearray(blocked) if blocked is not None else bytearray(width * height)
+        self.occupied = bytearray(width * height)
+
+    def in_bounds(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def is_blocked(self, x, y):
+        """ True for tiles blocked by the map itself (or outside of it) """
+        x, y = int(x), int(y)
+        return not self.in_bounds(x, y) or self.blocked[y * self.width + x] != 0
+
+    def is_walkable(self, x, y):
+        x, y = int(x), int(y)
+        if not self.in_bounds(x, y):
+            return False
+        i = y * self.width + x
+        return not self.blocked[i] and not self.occupied[i]
+
+    def memory_size(self):
+        return len(self.blocked) + len(self.occupied)
+
+    def occupy(self, position):
+        x, y = int(position[0]), int(position[1])
+        if self.in_bounds(x, y):
+            self.occupied[y * self.width + x] += 1
+
+    def release(self, position):
+        x, y = int(position[0]), int(position[1])
+        if self.in_bounds(x, y) and self.occupied[y * self.width + x]:
+            self.occupied[y * self.width + x] -= 1
@@ -0,0 +1,134 @@
+""" Runs the game without a window or a sound card, on a virtual clock,
+    driven by scripted input instead of a keyboard.
+
+    A script is a list of steps, which post keyboard events for the game's input layer:
+        ('press', key)              key down for one frame
+        ('hold', key, frames)       key down for a number of frames
+        ('walk', direction, tiles)  hold an arrow key until that many steps are taken
+        ('wait', frames)            no keys down
+        ('goto', state)             change straight to a state, e.g. 'FOREST'
+        ('place', x, y)             put the player on a tile
+"""
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+import pygame
+import time
+import clock
+from audio import sounds
+from game import Game
+from profiler import profiler
+from sprites import Vector
+
+KEYS = {
+    'up': pygame.K_UP,
+    'down': pygame.K_DOWN,
+    'left': pygame.K_LEFT,
+    'right': pygame.K_RIGHT,
+    'space': pygame.K_SPACE,
+    'escape': pygame.K_ESCAPE,
+    'f5': pygame.K_F5,
+    'f9': pygame.K_F9,
+}
+PHASES = ('events', 'update', 'draw', 'flip')
+
+
+class HeadlessGame(Game):
+    def __init__(self, dirty_rects=False, record=None, replay=None, renderer='auto'):
+        pygame.init()
+        super().__init__(dirty_rects, record, replay, renderer)
+        self.frame_millis = 1000 / self.fps
+        self.frames = 0
+        self.timings = {phase: [] for phase in PHASES}
+        self.entries = []       # (simulation steps run, state key) of every state change
+
+    def change_state(self, state):
+        super().change_state(state)
+        self.entries.append((self.simulated, self.states.key_of(state)))
+
+    def frame(self, millis=None):
+        """ Runs one frame (of `millis`, or frame_millis) the way Game.run does, timing each phase """
+        if self.state is None:
+            return
+        millis = self.frame_millis if millis is None else millis
+        self.frames += 1
+        self.delta_t = millis / 1000.0
+        started = time.perf_counter()
+        with profiler.scope('update'):
+            alpha = self.advance(millis)
+        if self.state is None:
+            return
+        self.preloader.update()
+        sounds.update()
+        updated = time.perf_counter()
+        with profiler.scope('draw'):
+            dirty = self.draw(alpha)
+        drawn = time.perf_counter()
+        with profiler.scope('flip'):
+            self.present(dirty)
+        presented = time.perf_counter()
+        with profiler.scope('events'):
+            self.state.events()
+        finished = time.perf_counter()
+        self.timings['update'].append(updated - started)
+        self.timings['draw'].append(drawn - updated)
+        self.timings['flip'].append(presented - drawn)
+        self.timings['events'].append(finished - presented)
+
+    def run_to(self, simulated):
+        """ Runs frames until `simulated` simulation steps have run, the last
+            frame cut short so as not to run past it (e.g. to stop a replay) """
+        while self.simulated < simulated and self.state is not None:
+            # (a hair over, so rounding never leaves the last step short)
+            needed = (simulated - self.simulated) * self.step_millis - self.lag + 1e-6
+            self.frame(min(self.frame_millis, needed))
+
+    def play(self, script):
+        for step in script:
+            action, args = step[0], step[1:]
+            if action == 'press':
+                self._hold(KEYS[args[0]], 1)
+            elif action == 'hold':
+                self._hold(KEYS[args[0]], args[1])
+            elif action == 'walk':
+                self._walk(args[0], args[1])
+            elif action == 'wait':
+                for _ in range(args[0]):
+                    self.frame()
+            elif action == 'goto':
+                self.change_state(self.states[args[0]])
+            elif action == 'place':
+                self.player.place(Vector(args[0], args[1]))
+            else:
+                raise ValueError("unknown script step", step)
+
+    def close(self):
+        self.preloader.close()
+        self.saves.close()
+        self.input.close()
+        clock.use(None)
+
+    def _hold(self, key, frames):
+        self._post(pygame.KEYDOWN, key)
+        for _ in range(frames):
+            self.frame()
+        self._post(pygame.KEYUP, key)
+
+    def _post(self, type, key):
+        # polled straight away, as if it happened between frames, so it reaches the next simulation step
+        pygame.event.post(pygame.event.Event(type, key=key))
+        if self.state is not None:
+            self.state.events()
+
+    def _walk(self, direction, tiles):
+        # give up once the player has stood still for a few frames (blocked)
+        self._post(pygame.KEYDOWN, KEYS[direction])
+        steps = idle = 0
+        while steps < tiles and idle < 5 and self.state is not None:
+            was_moving = self.player.is_moving
+            self.frame()
+            if was_moving and not self.player.is_moving:
+                steps += 1
+            idle = 0 if self.player.is_moving else idle + 1
+        self._post(pygame.KEYUP, KEYS[direction])
+        return steps
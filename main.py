@@ -1,8 +1,25 @@
+import argparse
 import pygame
 from game import Game
+from profiler import profiler
+from render import BACKENDS
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PockétMonsters: Gamboge")
+    parser.add_argument('--dirty', action='store_true', help="only redraw the parts of the screen that change")
+    parser.add_argument('--renderer', choices=BACKENDS, default='auto',
+                        help="draw with GPU textures or software surfaces (default: textures if accelerated)")
+    parser.add_argument('--profile', action='store_true', help="time the hot paths from the start")
+    parser.add_argument('--record', metavar='LOG', help="record the session's input to this file")
+    parser.add_argument('--replay', metavar='LOG', help="play back recorded input")
+    args = parser.parse_args()
     pygame.init()
-    Game().run()
+    profiler.enabled = args.profile
+    game = Game(dirty_rects=args.dirty, record=args.record, replay=args.replay, renderer=args.renderer)
+    if profiler.enabled:
+        print(game.states.report(game.startup_time))
+    game.run()
+    if profiler.enabled:
+        print(profiler.report())
     pygame.quit()
@@ -0,0 +1,184 @@
+import pygame
+import array
+import json
+import mmap
+import os
+import struct
+import sys
+from chunks import PixelBufferSource
+from os import path
+
+MAGIC = b'GMAP'
+VERSION = 3
+EXTENSION = '.gmap'
+_PREAMBLE = struct.Struct('<4sII')     # magic, version, header length
+_ALIGN = 16
+
+
+class CompiledMap:
+    """ Everything TiledMap needs from a map, whether it was just parsed from
+        a .tmx file or loaded from a compiled .gmap artifact """
+
+    def __init__(self, width, height, tile_size):
+        self.width = width      # in tiles
+        self.height = height    # in tiles
+        self.tile_size = (int(tile_size[0]), int(tile_size[1]))
+        self.sources = {}       # input file -> mtime_ns, used to detect stale artifacts
+        self.layers = []        # (name, row-major sequence of Tiled GIDs)
+        self.collision = bytearray(width * height)  # 1 for each blocked tile
+        self.exits = []         # (x, y, width, height, next_state, player_x, player_y)
+        self.music = None       # the map's 'music' property: a file in sfx/, if it has one
+        self.tiles = {}         # GID -> tile surface (or, before resolve_tiles, where to cut it from)
+        self.underfoot = None   # chunk sources for the layers under and over the characters
+        self.overhead = None
+        self.buffer = None      # keeps the memory map alive for the layer views
+
+
+def artifact_path(filename):
+    return path.splitext(filename)[0] + EXTENSION
+
+
+def source_stamps(*filenames):
+    """ Returns {filename: mtime_ns} for the inputs a compiled map depends on """
+    return {f: os.stat(f).st_mtime_ns for f in filenames}
+
+
+def is_current(filename, tile_size):
+    """ True if the artifact for `filename` exists and none of its inputs changed """
+    try:
+        with open(artifact_path(filename), 'rb') as f:
+            header = _read_header(f.read(_PREAMBLE.size), f)
+    except (OSError, ValueError):
+        return False
+    return _header_is_current(header, artifact_path(filename), tile_size)
+
+
+def composite(compiled):
+    """ Renders the layers under and over the characters into the RGB and RGBA buffers save() writes """
+    return _render_all(compiled.underfoot, 'RGB'), _render_all(compiled.overhead, 'RGBA')
+
+
+def save(compiled, filename, pixels=None):
+    """ Writes `compiled` to the artifact for the .tmx file `filename`;
+        `pixels` is what composite() returned, if it was already called """
+    underfoot, overhead = pixels if pixels is not None else composite(compiled)
+    target = artifact_path(filename)
+    base = path.dirname(target)
+    blobs = []
+    offset = 0
+
+    def add(data):
+        nonlocal offset
+        start = offset
+        blobs.append(data)
+        offset += len(data)
+        padding = -offset % _ALIGN
+        blobs.append(bytes(padding))
+        offset += padding
+        return [start, len(data)]
+
+    header = {
+        'width': compiled.width,
+        'height': compiled.height,
+        'tile_size': list(compiled.tile_size),
+        'sources': {path.relpath(f, base): t for f, t in compiled.sources.items()},
+        'layers': [[name, add(_to_little_endian(gids))] for name, gids in compiled.layers],
+        'collision': add(_pack_bits(compiled.collision)),
+        'exits': compiled.exits,
+        'music': compiled.music,
+        'underfoot': add(underfoot),
+        'overhead': add(overhead),
+    }
+    encoded = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    encoded += b' ' * (-(_PREAMBLE.size + len(encoded)) % _ALIGN)
+    with open(target + '.tmp', 'wb') as f:
+        f.write(_PREAMBLE.pack(MAGIC, VERSION, len(encoded)))
+        f.write(encoded)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(target + '.tmp', target)
+    return target
+
+
+def load(filename, tile_size):
+    """ Memory-maps the artifact for `filename`; returns None if it is missing or stale """
+    target = artifact_path(filename)
+    try:
+        with open(target, 'rb') as f:
+            header = _read_header(f.read(_PREAMBLE.size), f)
+            if not _header_is_current(header, target, tile_size):
+                return None
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    data = memoryview(buffer)[_PREAMBLE.size + header['length']:]
+
+    def blob(entry):
+        start, length = entry
+        return data[start:start + length]
+
+    compiled = CompiledMap(header['width'], header['height'], header['tile_size'])
+    compiled.buffer = buffer
+    compiled.sources = {path.normpath(path.join(path.dirname(target), f)): t
+                        for f, t in header['sources'].items()}
+    compiled.layers = [(name, _from_little_endian(blob(entry))) for name, entry in header['layers']]
+    compiled.collision = _unpack_bits(blob(header['collision']), compiled.width * compiled.height)
+    compiled.exits = [tuple(e) for e in header['exits']]
+    compiled.music = header['music']
+    size = (compiled.width * compiled.tile_size[0], compiled.height * compiled.tile_size[1])
+    compiled.underfoot = PixelBufferSource(blob(header['underfoot']), size, 'RGB')
+    compiled.overhead = PixelBufferSource(blob(header['overhead']), size, 'RGBA')
+    return compiled
+
+
+def _render_all(source, format):
+    return pygame.image.tostring(source.render(pygame.Rect((0, 0), source.get_size())), format)
+
+
+def _read_header(preamble, f):
+    if len(preamble) != _PREAMBLE.size:
+        raise ValueError('truncated map artifact')
+    magic, version, length = _PREAMBLE.unpack(preamble)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a version {} map artifact'.format(VERSION))
+    header = json.loads(f.read(length).decode('utf-8'))
+    header['length'] = length
+    return header
+
+
+def _header_is_current(header, target, tile_size):
+    if header['tile_size'] != [int(tile_size[0]), int(tile_size[1])]:
+        return False
+    for f, stamp in header['sources'].items():
+        source = path.join(path.dirname(target), f)
+        if not path.isfile(source) or os.stat(source).st_mtime_ns != stamp:
+            return False
+    return True
+
+
+def _to_little_endian(gids):
+    result = array.array('I', gids)
+    if sys.byteorder == 'big':
+        result.byteswap()
+    return result.tobytes()
+
+
+def _from_little_endian(view):
+    if sys.byteorder == 'big':
+        result = array.array('I', view.tobytes())
+        result.byteswap()
+        return result
+    return view.cast('I')
+
+
+def _pack_bits(flags):
+    result = bytearray((len(flags) + 7) // 8)
+    for i, flag in enumerate(flags):
+        if flag:
+            result[i >> 3] |= 1 << (i & 7)
+    return bytes(result)
+
+
+def _unpack_bits(view, count):
+    bits = bytes(view)
+    return bytearray((bits[i >> 3] >> (i & 7)) & 1 for i in range(count))
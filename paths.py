@@ -0,0 +1,190 @@
+""" Path finding on a map's collision grid, for NPCs that walk somewhere.
+
+    find_path() is A* for one NPC going to one place.  Distance fields are
+    for goals that many NPCs share (the player, the exits): a breadth-first
+    search out from the goals gives every tile its number of steps to the
+    nearest one, and an NPC just steps to whichever neighbour is closer.
+
+    Both only count the map's own obstacles, not characters, who move.  The
+    work is capped per simulation step: queries over the budget are refused
+    (ask again next step), and a field whose goals move is searched again a
+    slice at a time, while the NPCs keep following the last finished search.
+"""
+import heapq
+from array import array
+from collections import deque
+from profiler import profiler
+
+UNREACHABLE = 0x7fffffff    # distance of the tiles no goal can be reached from
+NEIGHBOURS = (('down', 0, 1), ('up', 0, -1), ('left', -1, 0), ('right', 1, 0))
+
+
+class DistanceField:
+    def __init__(self, grid, goals=()):
+        self.grid = grid
+        self.width, self.height = grid.width, grid.height
+        self.distance = array('i', [UNREACHABLE]) * (self.width * self.height)    # of the last finished search
+        self.goals = None
+        self.searches = 0           # finished searches
+        self._next = None           # distances of the search in progress
+        self._frontier = None
+        self.retarget(goals)
+
+    def retarget(self, goals):
+        """ Starts a new search towards the tiles `goals`, unless they are the ones it has """
+        goals = tuple(sorted({(int(x), int(y)) for x, y in goals if not self.grid.is_blocked(x, y)}))
+        if goals == self.goals:
+            return
+        self.goals = goals
+        self._next = array('i', [UNREACHABLE]) * (self.width * self.height)
+        self._frontier = deque()
+        for x, y in goals:
+            self._next[y * self.width + x] = 0
+            self._frontier.append(y * self.width + x)
+
+    def searching(self):
+        return self._frontier is not None
+
+    def advance(self, budget):
+        """ Takes up to `budget` tiles off the search in progress; returns how many it took """
+        frontier = self._frontier
+        if frontier is None:
+            return 0
+        distance, blocked = self._next, self.grid.blocked
+        width, height = self.width, self.height
+        taken = 0
+        while frontier and taken < budget:
+            i = frontier.popleft()
+            taken += 1
+            x, y = i % width, i // width
+            d = distance[i] + 1
+            for _, dx, dy in NEIGHBOURS:
+                nx, ny = x + dx, y + dy
+                if 0 <= nx < width and 0 <= ny < height:
+                    j = ny * width + nx
+                    if distance[j] > d and not blocked[j]:
+                        distance[j] = d
+                        frontier.append(j)
+        if not frontier:
+            self.distance, self._next, self._frontier = distance, None, None
+            self.searches += 1
+        return taken
+
+    def finish(self):
+        while self.searching():
+            self.advance(self.width * self.height)
+
+    def memory_size(self):
+        arrays = (self.distance, self._next)
+        return sum(a.itemsize * len(a) for a in arrays if a is not None)
+
+    def distance_at(self, x, y):
+        x, y = int(x), int(y)
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return UNREACHABLE
+        return self.distance[y * self.width + x]
+
+    def downhill(self, x, y):
+        """ The direction of the neighbour of tile (x, y) closest to a goal, if
+            it is closer than (x, y) is; None at a goal or out of reach """
+        best, here = None, self.distance_at(x, y)
+        for direction, dx, dy in NEIGHBOURS:
+            d = self.distance_at(x + dx, y + dy)
+            if d < here:
+                best, here = direction, d
+        return best
+
+
+class PathFinder:
+    """ A map's path finding: A* queries and the shared distance fields """
+
+    def __init__(self, map, query_budget=2048, field_budget=1024):
+        self.map = map
+        self.grid = map.grid
+        self.query_budget = query_budget    # tiles A* may expand per simulation step
+        self.field_budget = field_budget    # tiles the distance fields may search per simulation step
+        self.queries_left = query_budget
+        self.fields = {}                    # name -> DistanceField
+        self.queries = 0
+        self.refused = 0
+
+    def field(self, name):
+        """ The distance field towards 'player' or 'exits', searched the first time it is asked for """
+        field = self.fields.get(name)
+        if field is None:
+            field = self.fields[name] = DistanceField(self.grid, self._goals(name))
+            field.finish()
+        return field
+
+    def memory_size(self):
+        return sum(field.memory_size() for field in self.fields.values())
+
+    def update(self, player=None):
+        """ Refills the query budget and moves the fields on; call once a simulation step """
+        self.queries_left = self.query_budget
+        budget = self.field_budget
+        player_field = self.fields.get('player')
+        if player_field is not None and player is not None:
+            player_field.retarget([player.current_move])
+        if any(f.searching() for f in self.fields.values()):
+            with profiler.scope('path fields'):
+                for field in self.fields.values():
+                    budget -= field.advance(budget)
+
+    def find_path(self, start, goal, avoid=None):
+        """ The tiles from `start` to `goal` (the first one next to `start`,
+            the last one `goal`): empty if there is no way there, or None if
+            this step's budget is spent.  `avoid(x, y)` marks more tiles as
+            blocked, except for the goal. """
+        if self.queries_left <= 0:
+            self.refused += 1
+            return None
+        self.queries += 1
+        with profiler.scope('path query'):
+            path, expanded = self._search((int(start[0]), int(start[1])), (int(goal[0]), int(goal[1])), avoid)
+        self.queries_left -= expanded
+        return path
+
+    def _search(self, start, goal, avoid):
+        grid = self.grid
+        if start == goal or grid.is_blocked(*goal):
+            return [], 0
+        gx, gy = goal
+        came_from = {start: None}
+        cost = {start: 0}
+        count = 0       # breaks ties in insertion order, so equal paths always come out the same
+        frontier = [(abs(start[0] - gx) + abs(start[1] - gy), count, start)]
+        expanded = 0
+        while frontier:
+            _, _, tile = heapq.heappop(frontier)
+            if tile == goal:
+                path = []
+                while tile != start:
+                    path.append(tile)
+                    tile = came_from[tile]
+                return path[::-1], expanded
+            expanded += 1
+            x, y = tile
+            for _, dx, dy in NEIGHBOURS:
+                nx, ny = x + dx, y + dy
+                step = (nx, ny)
+                if grid.is_blocked(nx, ny) or (avoid is not None and step != goal and avoid(nx, ny)):
+                    continue
+                new_cost = cost[tile] + 1
+                if new_cost < cost.get(step, UNREACHABLE):
+                    cost[step] = new_cost
+                    came_from[step] = tile
+                    count += 1
+                    heapq.heappush(frontier, (new_cost + abs(nx - gx) + abs(ny - gy), count, step))
+        return [], expanded
+
+    def _goals(self, name):
+        if name == 'player':
+            player = self.map.game.player
+            return [player.current_move]
+        if name == 'exits':
+            tw, th = self.map.tile_size
+            return [(x, y) for exit in self.map.exits
+                    for x in range(exit.rect.left // int(tw), -(-exit.rect.right // int(tw)))
+                    for y in range(exit.rect.top // int(th), -(-exit.rect.bottom // int(th)))]
+        raise KeyError(name)
@@ -0,0 +1,98 @@
+""" Builds the states of the maps the player is walking towards before the
+    player gets there.  A worker thread reads the map data (and decodes the
+    tileset images); the surfaces are cut, converted and pre-rendered on the
+    main thread a little at a time, so no frame takes much longer than usual.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from profiler import profiler
+from state import AdventureState
+from world import load_map_data, resolve_tiles
+
+
+class MapPreloader:
+    def __init__(self, game, radius=4, budget_millis=4):
+        self.game = game
+        self.radius = radius                # in tiles, around each exit
+        self.budget = budget_millis / 1000  # main thread time per frame
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = {}       # state key -> (future, player position after the exit)
+        self.building = None    # (state key, generator) being finished on this thread
+        self.preloaded = 0
+
+    def update(self):
+        """ Starts loading the maps behind any exits the player is near, and
+            spends up to the per-frame budget finishing the ones that are read """
+        state = self.game.state
+        map = state.get_map() if state is not None else None
+        if map is not None:
+            self._watch(map)
+        deadline = time.perf_counter() + self.budget
+        while time.perf_counter() < deadline:
+            if self.building is None:
+                self.building = self._next_ready()
+                if self.building is None:
+                    return
+            try:
+                with profiler.scope('preload step'):
+                    next(self.building[1])
+            except StopIteration:
+                self.building = None
+
+    def close(self):
+        for future, _ in self.pending.values():
+            future.cancel()
+        self.executor.shutdown()
+        self.pending.clear()
+        self.building = None
+
+    def _watch(self, map):
+        states = self.game.states
+        ts = self.game.tile_size
+        player = self.game.player.rect
+        for exit in map.exits:
+            key = exit.next_state
+            if key in self.pending or key not in states.map_names or states.is_loaded(key):
+                continue
+            if player.colliderect(exit.rect.inflate(2 * self.radius * ts.x, 2 * self.radius * ts.y)):
+                future = self.executor.submit(load_map_data, states.map_names[key], ts)
+                self.pending[key] = (future, exit.player_position)
+
+    def _next_ready(self):
+        for key, (future, position) in list(self.pending.items()):
+            if future.done():
+                del self.pending[key]
+                try:
+                    data = future.result()
+                except Exception as e:
+                    print("preloading state {} failed: {}".format(key, e))
+                    continue
+                return key, self._build(key, data, position)
+        return None
+
+    def _build(self, key, data, position):
+        """ Finishes building a state, a step at a time """
+        steps = 0
+        if data.underfoot is None:
+            for _ in resolve_tiles(data):
+                steps += 1
+                yield
+        states = self.game.states
+        if states.is_loaded(key):
+            return  # the player got there first
+        state = AdventureState(self.game, self.game.player, states.map_names[key], self.game.camera, data)
+        states.add(key, state)
+        yield
+        #
+        # render the chunks the camera will show when the player arrives
+        ts = self.game.tile_size
+        view = self.game.screen.get_rect()
+        view.center = (int((position.x + 0.5) * ts.x), int((position.y + 0.5) * ts.y))
+        for layer in (state.map.underfoot, state.map.overhead):
+            view = view.clamp(layer.get_rect())
+            for column, row in layer.chunks_in(view):
+                layer.get_chunk(column, row)
+                steps += 1
+                yield
+        self.preloaded += 1
+        print("preloaded state {} in {} steps".format(key, steps))
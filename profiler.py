@@ -0,0 +1,145 @@
+""" Named timing scopes for the hot paths, with rolling percentiles, an
+    on-screen overlay (F3) and Chrome trace export (F4, opens in
+    chrome://tracing or https://ui.perfetto.dev).
+
+        with profiler.scope('draw'):
+            ...
+
+    While disabled, scope() returns a shared do-nothing context manager.
+"""
+import pygame
+import json
+import threading
+import time
+from collections import deque
+from fonts import fonts
+
+OVERLAY_KEY = pygame.K_F3
+TRACE_KEY = pygame.K_F4
+
+
+class _NullScope:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SCOPE = _NullScope()
+
+
+class _Scope:
+    __slots__ = ('profiler', 'name', 'started')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.started, time.perf_counter())
+        return False
+
+
+class Profiler:
+    def __init__(self, window=600, trace_capacity=200_000):
+        self.enabled = False
+        self.window = window        # samples kept per scope for the percentiles
+        self.samples = {}           # name -> deque of durations, in milliseconds
+        self.trace = deque(maxlen=trace_capacity)   # (name, thread, start, end) in perf_counter seconds
+        self.overlay = False
+        self.overlay_image = None
+        self.overlay_updated = 0
+        self.origin = time.perf_counter()
+
+    def scope(self, name):
+        if not self.enabled:
+            return _NULL_SCOPE
+        return _Scope(self, name)
+
+    def record(self, name, started, finished):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = deque(maxlen=self.window)
+        samples.append((finished - started) * 1000)
+        self.trace.append((name, threading.get_ident(), started, finished))
+
+    def percentiles(self, name, points=(50, 95, 99)):
+        samples = sorted(self.samples.get(name, ()))
+        if not samples:
+            return None
+        return tuple(samples[min(len(samples) - 1, len(samples) * p // 100)] for p in points)
+
+    def report(self):
+        lines = ["{:<14} {:>7} {:>7} {:>7} {:>6}".format('scope', 'p50 ms', 'p95 ms', 'p99 ms', 'count')]
+        for name in sorted(self.samples):
+            p50, p95, p99 = self.percentiles(name)
+            lines.append("{:<14} {:7.3f} {:7.3f} {:7.3f} {:6d}".format(name, p50, p95, p99, len(self.samples[name])))
+        return "\n".join(lines)
+
+    def export_trace(self, filename):
+        """ Writes the recorded scopes as Chrome trace JSON """
+        events = [{'name': name, 'ph': 'X', 'pid': 1, 'tid': thread,
+                   'ts': round((started - self.origin) * 1e6, 1), 'dur': round((finished - started) * 1e6, 1)}
+                  for name, thread, started, finished in list(self.trace)]
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        print("wrote {} trace events to {}".format(len(events), filename))
+        return filename
+
+    def clear(self):
+        self.samples.clear()
+        self.trace.clear()
+
+    def handle_key(self, key):
+        """ Handles the profiler's keys; True if `key` was one of them """
+        if key == OVERLAY_KEY:
+            self.overlay = not self.overlay
+            self.enabled = self.enabled or self.overlay
+            return True
+        if key == TRACE_KEY:
+            if self.enabled:
+                self.export_trace(time.strftime("trace-%Y%m%d-%H%M%S.json"))
+            else:
+                print("profiling is off; press F3 or start with --profile")
+            return True
+        return False
+
+    def overlay_rect(self, fps):
+        """ Where the overlay goes this frame, or None if it is not showing;
+            call before draw(), as this is when the overlay gets re-rendered """
+        if not self.overlay:
+            return None
+        now = time.perf_counter()
+        if self.overlay_image is None or now - self.overlay_updated > 0.25:
+            # re-rendered a few times a second, which is as fast as anyone can read it
+            self.overlay_image = self._render_overlay(fps)
+            self.overlay_updated = now
+        return self.overlay_image.get_rect(topleft=(4, 4))
+
+    def draw(self, screen):
+        """ Draws the overlay, if it is showing; returns the rect it covered, or None """
+        if not self.overlay or self.overlay_image is None:
+            return None
+        return screen.blit(self.overlay_image, (4, 4))
+
+    def _render_overlay(self, fps):
+        font = ('Courier New', 13, False)
+        lines = ["{:.1f} FPS".format(fps)] + self.report().split("\n")
+        surfaces = [fonts.get_font(*font).render(line, True, (255, 255, 0)) for line in lines]
+        width = max(s.get_width() for s in surfaces) + 8
+        height = sum(s.get_height() for s in surfaces) + 8
+        image = pygame.Surface((width, height))
+        image.fill((0, 0, 0))
+        top = 4
+        for surface in surfaces:
+            image.blit(surface, (4, top))
+            top += surface.get_height()
+        return image
+
+
+profiler = Profiler()
@@ -0,0 +1,155 @@
+""" Where frames get drawn.  SurfaceRenderer blits software surfaces onto
+    the display surface, as the game always has.  TextureRenderer draws with
+    pygame._sdl2's Renderer: each surface is uploaded as a Texture the first
+    time it is drawn and drawn as a textured quad from then on, so map
+    chunks, sprite frames and text stay on the GPU.
+
+    Both take the surface calls the states make (blit, fill, get_clip, ...)
+    with positions from Camera.apply(), so the drawing code is the same for
+    either.  create_renderer() falls back to surfaces when there is no
+    pygame._sdl2, no accelerated renderer, or only the dummy video driver.
+"""
+import os
+import pygame
+import weakref
+
+try:
+    from pygame._sdl2 import video
+except ImportError:
+    video = None
+
+BACKENDS = ('auto', 'texture', 'software')
+_BLEND = 1  # SDL_BLENDMODE_BLEND
+
+
+class SurfaceRenderer:
+    name = 'software'
+    dirty_rects = True      # can put just the changed parts of a frame on screen
+
+    def __init__(self, screen):
+        self.screen = screen
+
+    def get_size(self):
+        return self.screen.get_size()
+
+    def get_width(self):
+        return self.screen.get_width()
+
+    def get_height(self):
+        return self.screen.get_height()
+
+    def get_rect(self):
+        return self.screen.get_rect()
+
+    def get_clip(self):
+        return self.screen.get_clip()
+
+    def set_clip(self, rect):
+        self.screen.set_clip(rect)
+
+    def fill(self, color, rect=None):
+        return self.screen.fill(color, rect)
+
+    def blit(self, surface, dest, *, version=None):
+        return self.screen.blit(surface, dest)
+
+    def present(self, dirty=None):
+        if dirty is not None:
+            pygame.display.update(dirty)
+        else:
+            pygame.display.flip()
+
+    def stats(self):
+        return "renderer: software surfaces"
+
+
+class TextureRenderer:
+    """ Draws into a window of its own; the (hidden) display surface is still
+        set up, for converting images and for the screen size """
+    name = 'texture'
+    dirty_rects = False     # every frame is drawn whole, on the GPU
+
+    def __init__(self, window, renderer, size):
+        self.window = window
+        self.renderer = renderer
+        self.rect = pygame.Rect((0, 0), size)
+        self.textures = weakref.WeakKeyDictionary()     # surface -> (Texture, version)
+        self.uploads = 0
+        self.draws = 0
+
+    def get_size(self):
+        return self.rect.size
+
+    def get_width(self):
+        return self.rect.width
+
+    def get_height(self):
+        return self.rect.height
+
+    def get_rect(self):
+        return self.rect.copy()
+
+    def get_clip(self):
+        return self.rect.copy()
+
+    def set_clip(self, rect):
+        pass    # only dirty rectangles clip, and they are off
+
+    def fill(self, color, rect=None):
+        self.renderer.draw_color = pygame.Color(color)
+        if rect is None:
+            self.renderer.clear()
+            return self.get_rect()
+        rect = pygame.Rect(rect).clip(self.rect)
+        self.renderer.fill_rect(rect)
+        return rect
+
+    def blit(self, surface, dest, *, version=None):
+        """ Draws `surface` at `dest`, uploading it first if it is new, or if
+            `version` changed since it was uploaded (for surfaces drawn on) """
+        rect = pygame.Rect((dest[0], dest[1]), surface.get_size())
+        alpha = surface.get_alpha()
+        if alpha == 0:
+            return pygame.Rect(rect.topleft, (0, 0))
+        texture = self.texture(surface, version)
+        if alpha is not None:
+            texture.alpha = alpha
+            texture.blend_mode = _BLEND
+        texture.draw(dstrect=rect)
+        self.draws += 1
+        return rect.clip(self.rect)
+
+    def texture(self, surface, version=None):
+        entry = self.textures.get(surface)
+        if entry is None or entry[1] != version:
+            entry = self.textures[surface] = (video.Texture.from_surface(self.renderer, surface), version)
+            self.uploads += 1
+        return entry[0]
+
+    def present(self, dirty=None):
+        self.renderer.present()
+
+    def stats(self):
+        return "renderer: {} textures uploaded ({} alive), {} drawn".format(self.uploads, len(self.textures), self.draws)
+
+
+def create_renderer(size, title, backend='auto'):
+    """ Opens the display and returns (display surface, renderer) for `backend`:
+        'texture', 'software', or 'auto' for textures if they are accelerated """
+    if backend not in BACKENDS:
+        raise ValueError("unknown renderer {!r}; choose from {}".format(backend, ", ".join(BACKENDS)))
+    pygame.display.set_caption(title)
+    if backend != 'software' and video is not None \
+            and (backend == 'texture' or os.environ.get('SDL_VIDEODRIVER') != 'dummy'):
+        screen = pygame.display.set_mode(size, pygame.HIDDEN)
+        try:
+            window = video.Window(title, size)
+            renderer = video.Renderer(window, accelerated=1 if backend == 'auto' else -1)
+        except (pygame.error, video.error) as e:
+            print("no texture renderer ({}); drawing with surfaces".format(e))
+        else:
+            return screen, TextureRenderer(window, renderer, size)
+    elif backend == 'texture':
+        print("no pygame._sdl2; drawing with surfaces")
+    screen = pygame.display.set_mode(size)
+    return screen, SurfaceRenderer(screen)
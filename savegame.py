@@ -0,0 +1,287 @@
+""" Snapshots of the game: which state is running, the player, the message
+    box and every map's NPCs, in a small versioned binary file.
+
+    The file is a header followed by snapshots.  The first snapshot has every
+    section; each later one only has the sections that changed, and is
+    appended by a background thread so saving never waits on the disk.  Once
+    enough deltas pile up the file is rewritten as a single full snapshot.
+
+        header      b'GSAV', version (u16)
+        snapshot    b'SNAP', payload length (u32), payload, crc32 of payload (u32)
+        payload     section count (u16), then per section: name, data length (u32), data
+
+    Strings are a u16 byte length and UTF-8.  Loading replays the snapshots in
+    order, and stops at the first damaged one (e.g. a write cut short).
+"""
+import pygame
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from sprites import FACING_ROWS, Vector
+
+MAGIC = b'GSAV'
+VERSION = 1
+SNAPSHOT = b'SNAP'
+SAVE_DIR = path.join(path.dirname(path.abspath(__file__)), 'saves')
+AUTOSAVE = path.join(SAVE_DIR, 'autosave.gsav')
+FACINGS = tuple(sorted(FACING_ROWS, key=FACING_ROWS.get))
+SAVE_KEY = pygame.K_F5
+LOAD_KEY = pygame.K_F9
+
+_HEADER = struct.Struct('<4sH')
+_SNAPSHOT = struct.Struct('<4sI')
+_U16 = struct.Struct('<H')
+_U32 = struct.Struct('<I')
+_GAME = struct.Struct('<Q')         # simulation steps
+_PLAYER = struct.Struct('<hhB')     # x, y, facing
+_MESSAGE = struct.Struct('<qB')     # ticks, showing
+_NPC = struct.Struct('<HhhBH')      # index in the map, x, y, facing, next line of dialogue
+
+
+class SnapshotManager:
+    def __init__(self, game, filename=AUTOSAVE, autosave_millis=30_000, max_deltas=32):
+        self.game = game
+        self.filename = filename
+        self.autosave_millis = autosave_millis      # of game time
+        self.max_deltas = max_deltas                # before the file is rewritten in full
+        self.written = {}       # section -> the bytes last saved for it
+        self.maps = {}          # state key -> saved NPC data, for maps that are not loaded
+        self.deltas = 0
+        self.last_save = 0
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.pending = None     # Future of the last write
+        game.states.listeners.append(self)
+
+    def update(self):
+        """ Autosaves every `autosave_millis` of game time, while on a map; call once a simulation step """
+        ticks = self.game.sim_clock.ticks
+        if self.autosave_millis and ticks - self.last_save >= self.autosave_millis \
+                and self.game.state is not None and self.game.state.get_map() is not None:
+            self.save()
+
+    def handle_key(self, key, saving=True):
+        """ F5 saves (if `saving`), F9 loads; True if `key` was one of them """
+        if key == SAVE_KEY and saving:
+            self.save()
+            return True
+        if key == LOAD_KEY:
+            self.load()
+            return True
+        return False
+
+    def save(self):
+        """ Captures the game now and writes what changed on the writer thread """
+        self.last_save = self.game.sim_clock.ticks
+        if self.game.states.key_of(self.game.state) is None:
+            print("nothing to save: no game state is running")
+            return self.pending
+        if self.pending is not None and self.pending.done():
+            self.flush()    # (to hear about a failed write before appending to it)
+        sections = self.capture()
+        changed = {name: data for name, data in sections.items() if self.written.get(name) != data}
+        if not changed:
+            return self.pending
+        self.written.update(changed)
+        if not self.deltas or self.deltas >= self.max_deltas:
+            self.deltas = 1
+            delta = None
+        else:
+            self.deltas += 1
+            delta = encode_snapshot(changed)
+        # (the full snapshot is only encoded, on the writer thread, if it is the one written)
+        self.pending = self.writer.submit(_write, self.filename, dict(self.written), delta)
+        return self.pending
+
+    def load(self):
+        """ Restores the last save; the maps are rebuilt as they are needed """
+        self.flush()
+        try:
+            sections, snapshots = read(self.filename)
+        except (OSError, ValueError) as e:
+            print("cannot load {}: {}".format(self.filename, e))
+            return False
+        states = self.game.states
+        key, steps = decode_game(sections['game'])
+        if key not in states:
+            print("cannot load {}: it has no game state {!r}".format(self.filename, key))
+            return False
+        for loaded in list(states.states):
+            if loaded in states.map_names:
+                states.discard(loaded)
+        self.written = dict(sections)
+        self.deltas = snapshots
+        self.maps = {name[4:]: data for name, data in sections.items() if name.startswith('map:')}
+        self.game.steps = steps
+        self.game.sim_clock.ticks = self.last_save = round(steps * self.game.step_millis)
+        player = self.game.player
+        x, y, facing = _PLAYER.unpack(sections['player'])
+        player.is_moving = False
+        player.facing = FACINGS[facing]
+        self.game.change_state(states[key])
+        player.place(Vector(x, y))
+        player.image = player.standing_image()
+        text, ticks, showing = decode_message(sections['messages'])
+        if text is not None:
+            messages = self.game.messages
+            messages.set_message(text)
+            messages.ticks = ticks
+            if not showing:
+                messages.image.set_alpha(0)
+        return True
+
+    def flush(self):
+        """ Waits for the last write to reach the disk; False if it failed """
+        pending, self.pending = self.pending, None
+        if pending is not None:
+            try:
+                pending.result()
+            except OSError as e:
+                print("cannot save {}: {}".format(self.filename, e))
+                self.written, self.deltas = {}, 0   # so the next save is written in full
+                return False
+        return True
+
+    def close(self):
+        self.flush()
+        self.writer.shutdown()
+
+    def capture(self):
+        game = self.game
+        states = game.states
+        player = game.player
+        messages = game.messages
+        sections = {
+            'game': encode_game(states.key_of(game.state), game.steps),
+            'player': _PLAYER.pack(int(player.position.x), int(player.position.y), FACINGS.index(player.facing)),
+            'messages': encode_message(messages.text, messages.ticks, messages.image.get_alpha() != 0),
+        }
+        for key, data in self.maps.items():
+            sections['map:' + key] = data
+        for key, state in states.states.items():
+            if key in states.map_names and state is not None:
+                sections['map:' + key] = encode_npcs(state.map)
+        return sections
+
+    # StateRegistry listener
+
+    def state_built(self, key, state):
+        data = self.maps.pop(key, None)
+        if data is not None:
+            restore_npcs(state.map, data)
+
+    def state_evicted(self, key, state):
+        if key in self.game.states.map_names:
+            self.maps[key] = encode_npcs(state.map)
+
+
+def encode_snapshot(sections):
+    payload = [_U16.pack(len(sections))]
+    for name in sorted(sections):
+        data = sections[name]
+        payload += [_pack_string(name), _U32.pack(len(data)), data]
+    payload = b''.join(payload)
+    return _SNAPSHOT.pack(SNAPSHOT, len(payload)) + payload + _U32.pack(zlib.crc32(payload))
+
+
+def read(filename):
+    """ Returns the latest data of every section, and the number of snapshots """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if len(data) < _HEADER.size:
+        raise ValueError('not a save file')
+    magic, version = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('not a version {} save file'.format(VERSION))
+    sections = {}
+    snapshots = 0
+    offset = _HEADER.size
+    while offset + _SNAPSHOT.size <= len(data):
+        tag, length = _SNAPSHOT.unpack_from(data, offset)
+        start, end = offset + _SNAPSHOT.size, offset + _SNAPSHOT.size + length
+        if tag != SNAPSHOT or end + _U32.size > len(data) \
+                or _U32.unpack_from(data, end)[0] != zlib.crc32(data[start:end]):
+            print("{}: ignoring a damaged snapshot at byte {}".format(filename, offset))
+            break
+        payload = memoryview(data)[start:end]
+        (count,), at = _U16.unpack_from(payload), _U16.size
+        for _ in range(count):
+            name, at = _unpack_string(payload, at)
+            (size,), at = _U32.unpack_from(payload, at), at + _U32.size
+            sections[name] = bytes(payload[at:at + size])
+            at += size
+        snapshots += 1
+        offset = end + _U32.size
+    if not snapshots:
+        raise ValueError('no snapshots')
+    return sections, snapshots
+
+
+def encode_game(key, steps):
+    return _pack_string(key or '') + _GAME.pack(steps)
+
+
+def decode_game(data):
+    key, at = _unpack_string(data, 0)
+    return key, _GAME.unpack_from(data, at)[0]
+
+
+def encode_message(text, ticks, showing):
+    return _pack_string(text or '') + _MESSAGE.pack(ticks or 0, showing)
+
+
+def decode_message(data):
+    text, at = _unpack_string(data, 0)
+    ticks, showing = _MESSAGE.unpack_from(data, at)
+    return text or None, ticks, bool(showing)
+
+
+def encode_npcs(map):
+    records = [_U16.pack(len(map.npcs))]
+    for i, npc in enumerate(map.npcs):
+        # a moving NPC is saved where it is going
+        records.append(_NPC.pack(i, int(npc.current_move.x), int(npc.current_move.y),
+                                 FACINGS.index(npc.facing), npc.line))
+    return b''.join(records)
+
+
+def restore_npcs(map, data):
+    (count,) = _U16.unpack_from(data)
+    for i in range(count):
+        index, x, y, facing, line = _NPC.unpack_from(data, _U16.size + i * _NPC.size)
+        if index < len(map.npcs):
+            npc = map.npcs[index]
+            npc.line = line
+            map.move_npc(npc, Vector(x, y), FACINGS[facing])
+
+
+def _pack_string(text):
+    encoded = text.encode('utf-8')
+    return _U16.pack(len(encoded)) + encoded
+
+
+def _unpack_string(data, at):
+    (length,) = _U16.unpack_from(data, at)
+    at += _U16.size
+    return bytes(data[at:at + length]).decode('utf-8'), at + length
+
+
+def _write(filename, sections, delta):
+    # appends `delta`, or replaces the file with a full snapshot of `sections` if there is no delta (or no file)
+    started = time.perf_counter()
+    os.makedirs(path.dirname(filename), exist_ok=True)
+    if delta is None or not path.exists(filename):
+        full = encode_snapshot(sections)
+        temporary = filename + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, VERSION))
+            f.write(full)
+        os.replace(temporary, filename)
+        written = len(full)
+    else:
+        with open(filename, 'ab') as f:
+            f.write(delta)
+        written = len(delta)
+    return written, time.perf_counter() - started
@@ -0,0 +1,104 @@
+class SpatialHash:
+    """ A uniform grid of buckets, each `cell` tiles square, holding the
+        entities whose tile rects touch it.  Rects are (x, y, width, height)
+        in tiles, so queries only look at the buckets around them.  Queries
+        return the nearest entities first, ties in the order they were inserted,
+        so that the same map always answers the same way. """
+
+    def __init__(self, cell=4):
+        self.cell = cell
+        self.buckets = {}   # (column, row) -> set of entities
+        self.rects = {}     # entity -> its tile rect
+        self.order = {}     # entity -> when it was inserted
+        self.inserted = 0
+
+    def __contains__(self, entity):
+        return entity in self.rects
+
+    def __len__(self):
+        return len(self.rects)
+
+    def insert(self, entity, rect):
+        self.move(entity, rect)
+
+    def move(self, entity, rect):
+        """ Puts `entity` at `rect`, touching only the buckets that change """
+        rect = tuple(int(v) for v in rect)
+        old = self.rects.get(entity)
+        if old == rect:
+            return
+        old_cells = self._cells(old) if old is not None else ()
+        new_cells = self._cells(rect)
+        for cell in old_cells:
+            if cell not in new_cells:
+                bucket = self.buckets[cell]
+                bucket.discard(entity)
+                if not bucket:
+                    del self.buckets[cell]
+        for cell in new_cells:
+            if cell not in old_cells:
+                self.buckets.setdefault(cell, set()).add(entity)
+        self.rects[entity] = rect
+        if entity not in self.order:
+            self.order[entity] = self.inserted
+            self.inserted += 1
+
+    def remove(self, entity):
+        rect = self.rects.pop(entity, None)
+        self.order.pop(entity, None)
+        if rect is not None:
+            for cell in self._cells(rect):
+                bucket = self.buckets[cell]
+                bucket.discard(entity)
+                if not bucket:
+                    del self.buckets[cell]
+
+    def clear(self):
+        self.buckets.clear()
+        self.rects.clear()
+        self.order.clear()
+
+    def query(self, rect, group=None):
+        """ The entities whose rects overlap `rect`, nearest to its middle first;
+            only members of `group` (anything supporting `in`, e.g. a sprite
+            Group) if it is given """
+        x, y, w, h = rect
+        found = []
+        seen = set()
+        for cell in self._cells(rect):
+            for entity in self.buckets.get(cell, ()):
+                if entity in seen:
+                    continue
+                seen.add(entity)
+                ex, ey, ew, eh = self.rects[entity]
+                if ex < x + w and x < ex + ew and ey < y + h and y < ey + eh \
+                        and (group is None or entity in group):
+                    found.append(entity)
+        if len(found) > 1:
+            # (the buckets are sets, so without this the order would depend on hashing)
+            cx, cy = 2 * x + w, 2 * y + h
+            rects, order = self.rects, self.order
+            found.sort(key=lambda e: ((2 * rects[e][0] + rects[e][2] - cx) ** 2
+                                      + (2 * rects[e][1] + rects[e][3] - cy) ** 2, order[e]))
+        return found
+
+    def near(self, x, y, tiles, group=None):
+        """ The entities within `tiles` tiles (in both directions) of tile x, y """
+        return self.query((int(x) - tiles, int(y) - tiles, 2 * tiles + 1, 2 * tiles + 1), group)
+
+    def at(self, x, y, group=None):
+        return self.query((int(x), int(y), 1, 1), group)
+
+    def _cells(self, rect):
+        x, y, w, h = rect
+        c = self.cell
+        return {(column, row)
+                for row in range(y // c, (y + max(h, 1) - 1) // c + 1)
+                for column in range(x // c, (x + max(w, 1) - 1) // c + 1)}
+
+
+def tile_rect(rect, tile_size):
+    """ The tiles a pixel Rect overlaps, as an (x, y, width, height) tile rect """
+    tw, th = int(tile_size[0]), int(tile_size[1])
+    x, y = rect.left // tw, rect.top // th
+    return x, y, max(1, -(-rect.right // tw) - x), max(1, -(-rect.bottom // th) - y)
@@ -1,9 +1,21 @@
 import pygame
+import clock
+import controls
+import random
+from audio import FOOTSTEP, sounds
+from animation import AnimationSequence
+from fonts import fonts
+from profiler import profiler
 from os import path
 from spritesheet import *
+from worlddata import world
 
 Vector = pygame.math.Vector2
 
+FACING_ROWS = {'down': 0, 'left': 1, 'right': 2, 'up': 3}   # rows of the character sprite sheets
+WANDER_CHANCE = 1 / 120     # chance per simulation step that a standing 'wander' NPC sets off
+PATROL_WAIT = 30            # simulation steps a patrol waits when even a fresh path is blocked
+
 DIRECTIONS = {
     'down': Vector(0, 1),
     'up': Vector(0, -1),
@@ -25,119 +37,245 @@ class Character(pygame.sprite.Sprite):
         self.started_moving = None
         self.millis_per_grid_sq = 200
         self.rect = None
-        self.footstep = pygame.mixer.Sound("./sfx/footstep.wav")
+        self.previous_rect = None   # where rect was before the last simulation step
+        self.render_rect = None     # rect interpolated between the last two steps
+        self.solid = False  # solid characters block the tile they stand on
+        self.footstep = FOOTSTEP
+        self.sound_priority = 0     # see SoundManager.play()
+        self.sound_group = None
+        self.sound_limit = None
+
+    def get_map(self):
+        state = self.game.state
+        return state.get_map() if state is not None else None
+
+    def set_sprite_sheet(self, sprite_sheet):
+        """ Uses a 3x4 character sheet: a row per FACING_ROWS, columns step, stand, step """
+        self.sprite_sheet = sprite_sheet
+        self.walks = {
+            facing: AnimationSequence((sprite_sheet.get_frame(0, row), sprite_sheet.get_frame(2, row)),
+                                      self.millis_per_grid_sq)
+            for facing, row in FACING_ROWS.items()
+        }
+        self.image = self.standing_image()
+
+    def standing_image(self):
+        return self.sprite_sheet.get_frame(1, FACING_ROWS[self.facing])
 
     def start_moving(self, direction):
         if not self.is_moving:
-            self.started_moving = pygame.time.get_ticks()
+            self.started_moving = clock.get_ticks()
             self.facing = direction
             self.current_move = self.position + DIRECTIONS[self.facing]
-            if pygame.sprite.spritecollide(self, self.game.state.map.obstacles, False, test_for_collision):
+            map = self.get_map()
+            with profiler.scope('collision'):
+                walkable = map.grid.is_walkable(self.current_move.x, self.current_move.y)
+            if not walkable:
                 self.current_move = self.position
                 self.is_moving = False
+                self.image = self.standing_image()
             else:
-                self.footstep.play()
+                if self.solid:
+                    map.grid.occupy(self.current_move)
+                self.reindex_move()
+                map.animations.play(self, self.walks[self.facing], self.started_moving)
+                self.play_footstep()
                 self.is_moving = True
 
     def update(self):
         super().update()
+        self.previous_rect = self.rect.copy()
         if self.is_moving:
-            ticks = pygame.time.get_ticks() - self.started_moving
+            ticks = clock.get_ticks() - self.started_moving
             diff = min(ticks / self.millis_per_grid_sq, 1.0)
             distance = diff * DIRECTIONS[self.facing]
             self.move_rect(self.position, distance)
             if diff == 1.0:
+                if self.solid:
+                    self.get_map().grid.release(self.position)
                 self.move_rect(self.current_move)
                 self.is_moving = False
+                self.image = self.standing_image()
 
+    def place(self, position):
+        """ Puts the character straight onto `position`, without interpolating """
+        self.move_rect(position)
+        self.previous_rect = self.rect.copy()
 
-    def move_rect(self, position, distance=Vector(0, 0)):
-        if distance.x==0 and distance.y==0:
+    def interpolate(self, alpha):
+        """ Sets render_rect `alpha` (0..1) of the way from previous_rect to rect """
+        if self.previous_rect is None or alpha >= 1.0:
+            self.render_rect = self.rect
+        else:
+            x = self.previous_rect.x + (self.rect.x - self.previous_rect.x) * alpha
+            y = self.previous_rect.y + (self.rect.y - self.previous_rect.y) * alpha
+            self.render_rect = pygame.Rect((round(x), round(y)), self.rect.size)
+        return self.render_rect
+
+    def move_rect(self, position, distance=None):
+        if distance is None:
+            # no distance means the character is now standing on `position`
             self.position = self.current_move = position
+            distance = Vector(0, 0)
+            self.reindex((position.x, position.y, 1, 1))
         loc = Vector((position.x + distance.x) * self.tile_size.x , (position.y + distance.y + 1) * self.tile_size.y)
         self.rect.bottomleft = (loc.x, loc.y)
 
+    def play_footstep(self):
+        if self.footstep is not None:
+            sounds.play(self.footstep, self.sound_priority, self.sound_group, self.sound_limit)
+
+    def reindex(self, rect):
+        """ Moves the character to tile `rect` in its map's spatial index """
+        map = self.get_map()
+        if map is not None:
+            map.index.move(self, rect)
+
+    def reindex_move(self):
+        # indexed on both tiles until the move is over
+        self.reindex((min(self.position.x, self.current_move.x), min(self.position.y, self.current_move.y),
+                      abs(self.current_move.x - self.position.x) + 1,
+                      abs(self.current_move.y - self.position.y) + 1))
+
 
 class Player(Character):
     def __init__(self, game, position, *groups):
         super().__init__(game, position, groups)
         self.player_img = path.join(path.dirname(__file__), 'images', 'p017.png')
-        self.sprite_sheet = SpriteSheetGrid(self.player_img, 3, 4, color_key=None, has_alpha=True)
-        self.image = self.sprite_sheet.get_image(0)
+        self.set_sprite_sheet(load_grid(self.player_img, 3, 4, color_key=None, has_alpha=True))
         self.rect = self.image.get_rect()
         self.move_rect(self.position)
+        self.sound_priority = 10    # the player's own sounds are never drowned out
 
     def update(self):
         self.read_controls()
         was_moving = self.is_moving
         super().update()
-
-        if self.is_moving:
-            ticks = pygame.time.get_ticks() - self.started_moving
-            diff = min(ticks / self.millis_per_grid_sq, 1.0)
-            anim = 0 if diff < 0.5 else 2
-        else:
-            anim = 1
-
         if was_moving and not self.is_moving:
-            exit = pygame.sprite.spritecollideany(self, self.game.state.map.exits)
+            exit = self.get_map().exit_at(self.position.x, self.position.y)
             if exit:
                 print(exit.next_state, exit.player_position)
                 self.game.change_state(self.game.states[exit.next_state])
-                self.move_rect(exit.player_position)
-
-        # if I did, print the new coordinates
-        # then move the player and load the new map
-        if self.facing == 'up':
-            self.image = self.sprite_sheet.get_image((anim, 3))
-        elif self.facing == 'down':
-            self.image = self.sprite_sheet.get_image((anim, 0))
-        elif self.facing == 'left':
-            self.image = self.sprite_sheet.get_image((anim, 1))
-        elif self.facing == 'right':
-            self.image = self.sprite_sheet.get_image((anim, 2))
+                self.place(exit.player_position)
+            else:
+                creature = self.get_map().encounters.step(self.position.x, self.position.y)
+                if creature is not None:
+                    self.game.messages.set_message("A wild {} appeared!".format(creature))
 
     def read_controls(self):
         if not self.is_moving:
-            keys = pygame.key.get_pressed()
-            if keys[pygame.K_DOWN] or keys[pygame.K_s]:
-                self.image = self.sprite_sheet.get_image(0)
-                self.start_moving('down')
-            if keys[pygame.K_UP] or keys[pygame.K_w]:
-                self.image = self.sprite_sheet.get_image(1)
-                self.start_moving('up')
-            if keys[pygame.K_LEFT] or keys[pygame.K_a]:
-                self.image = self.sprite_sheet.get_image(2)
-                self.start_moving('left')
-            if keys[pygame.K_RIGHT] or keys[pygame.K_d]:
-                self.image = self.sprite_sheet.get_image(3)
-                self.start_moving('right')
-            if keys[pygame.K_SPACE]:
-                s = pygame.sprite.spritecollideany(self, self.game.state.map.interacts, nearby)
-                if s: s.interact()
+            input = self.game.input
+            if input.direction is not None:
+                self.start_moving(input.direction)
+            if input.take(controls.INTERACT):
+                map = self.get_map()
+                for s in map.entities_near(self.position, 1, map.interacts):
+                    s.interact()
+                    break
 
 
 class NPC(Character):
-    def __init__(self, game, name, position, img, *groups):
+    def __init__(self, game, name, position, img, *groups, npc_id=None, script=None):
         super().__init__(game, position, groups)
         self.name = name
+        self.npc_id = npc_id    # its row in the world data store
+        self.script = script
+        self.line = 0           # the line of dialogue to say next
         self.img_file = path.join(path.dirname(__file__), 'images', img + '.png')
-        self.sprite_sheet = SpriteSheetGrid(self.img_file, 3, 4, color_key=None, has_alpha=True)
-        self.image = self.sprite_sheet.get_image(1)
+        self.set_sprite_sheet(load_grid(self.img_file, 3, 4, color_key=None, has_alpha=True))
         self.rect = self.image.get_rect()
         self.move_rect(self.position)
-        self.message = "Bob:  Hey! You can't leave town yet."
+        self.solid = True
+        self.sound_group = 'npc footsteps'
+        self.sound_limit = 4
+        self.get_map().grid.occupy(self.position)
+        self.random = random.Random("{}:{}:{}".format(name, position.x, position.y))
+        self.patrol = patrol_route(script, position)   # tiles to walk between, for a 'patrol x,y ...' script
+        self.waypoint = 0       # the patrol tile being walked to
+        self.path = None        # the tiles left on the way there
+        self.waiting = 0        # simulation steps before it tries again
+
+    def get_map(self):
+        # NPCs are created by (and given) their TiledMap rather than the game
+        return self.game
+
+    def update(self):
+        # the one-at-a-time path; see crowd.py for moving many NPCs at once
+        if not self.is_moving:
+            if self.script == 'wander' and self.random.random() < WANDER_CHANCE:
+                self.wander()
+            elif self.script == 'follow':
+                self.follow()
+            elif self.patrol:
+                self.walk_patrol()
+        super().update()
+
+    def wander(self):
+        self.step(self.random.choice(('down', 'up', 'left', 'right')))
+
+    def follow(self):
+        """ Walks towards the player, along the map's distance field, and stops next to them """
+        field = self.get_map().paths.field('player')
+        if field.distance_at(self.position.x, self.position.y) > 1:
+            direction = field.downhill(self.position.x, self.position.y)
+            if direction is not None:
+                self.step(direction)
+
+    def walk_patrol(self):
+        """ Walks the next step of the patrol, asking for a path to the next tile of it when there is none """
+        if self.waiting:
+            self.waiting -= 1
+            return
+        fresh = not self.path
+        if fresh:
+            if self.position == self.patrol[self.waypoint]:
+                self.waypoint = (self.waypoint + 1) % len(self.patrol)
+            grid = self.get_map().grid
+            player = self.get_map().game.player
+            blocked = self.path is not None     # once blocked on the way, go round whoever is standing in it
+
+            def avoid(x, y):
+                # the player is not in the grid, so they are avoided the way step() does
+                return (x, y) == player.position or (x, y) == player.current_move \
+                    or (blocked and not grid.is_walkable(x, y))
+
+            self.path = self.get_map().paths.find_path(self.position, self.patrol[self.waypoint], avoid)
+            if self.path is None:
+                return      # no budget left this step
+            if not self.path:
+                self.waypoint = (self.waypoint + 1) % len(self.patrol)
+                self.path = None
+                return
+        target = Vector(self.path[0])
+        for direction, offset in DIRECTIONS.items():
+            if self.position + offset == target and self.step(direction):
+                self.path = self.path[1:] or None
+                return
+        self.path = []      # blocked, or knocked off the path: find another next step
+        if fresh:
+            self.waiting = PATROL_WAIT      # even the way round is blocked: give it a moment
+
+    def step(self, direction):
+        """ Starts moving in `direction`, unless the player is in the way; True if it did """
+        target = self.position + DIRECTIONS[direction]
+        player = self.get_map().game.player
+        if target != player.position and target != player.current_move:
+            self.start_moving(direction)
+        return self.is_moving
 
     def interact(self):
-        if self.message is not None:
-            self.game.messages.set_message(self.message)
+        lines = world.dialogue(self.npc_id) if self.npc_id is not None else ()
+        if lines:
+            self.game.messages.set_message("{}:  {}".format(self.name, lines[self.line % len(lines)]))
+            self.line = (self.line + 1) % len(lines)
 
 
-class Obstacle(pygame.sprite.Sprite):
-    def __init__(self, game, position, *groups):
-        super().__init__(groups)
-        ts = game.tile_size
-        self.rect = pygame.Rect(position.x * ts.x, position.y * ts.y, ts.x, ts.y)
+def patrol_route(script, position):
+    """ The tiles of a 'patrol x,y x,y ...' script, starting with `position`; None for any other script """
+    if not script or not script.startswith('patrol '):
+        return None
+    return [Vector(position)] + [Vector(int(x), int(y)) for x, y in
+                                 (tile.split(',') for tile in script.split()[1:])]
 
 
 class Exit(pygame.sprite.Sprite):
@@ -161,31 +299,11 @@ class MessageBox(pygame.sprite.Sprite):
     def set_message(self, msg):
         self.image.set_alpha(200)
         self.image.fill(0)
-        f = pygame.font.SysFont('Ariel', 20)
-        surface = f.render(msg, True, (255,255,255))
+        surface = fonts.render(msg, ('Ariel', 20, False), (255,255,255))
         self.image.blit(surface, (5,5))
-        self.ticks = pygame.time.get_ticks()
+        self.text = msg
+        self.ticks = clock.get_ticks()
 
     def update(self):
-        if pygame.time.get_ticks() - self.ticks > 2_000:
+        if clock.get_ticks() - self.ticks > 2_000:
             self.image.set_alpha(0)
-
-
-def test_for_collision(one, two):
-    r = pygame.Rect(
-        one.current_move.x * one.game.tile_size.x,
-        one.current_move.y * one.game.tile_size.y,
-        one.game.tile_size.x, one.game.tile_size.y
-    )
-    return r.colliderect(two.rect)
-
-
-def nearby(one, two):
-    ts = one.game.tile_size
-    r = pygame.Rect(
-        one.position.x * ts.x - ts.x,
-        one.position.y * ts.y - ts.y,
-        3*ts.x, 3*ts.y
-    )
-    return r.colliderect(two.rect)
-
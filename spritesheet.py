@@ -24,10 +24,9 @@ class SpriteSheet:
         """ Gets the image in `rect` from the sprite sheet """
         if not isinstance(rect, pygame.Rect):
             rect = pygame.Rect(rect)
-        key = str(rect)
-        if key in self.cache:
-            result = self.cache[key]
-        else:
+        key = (rect.x, rect.y, rect.w, rect.h)
+        result = self.cache.get(key)
+        if result is None:
             result = _extract_sprite_image(self.sheet, rect, self.color_key, self.has_alpha)
             self.cache[key] = result
         return result
@@ -40,13 +39,22 @@ class SpriteSheet:
 
 
 class SpriteSheetGrid(SpriteSheet):
-    """ A sprite sheet with a grid of images """
+    """ A sprite sheet with a grid of images, all sliced up front into
+        `frames`, a row-major tuple indexed by frame number """
     def __init__(self, img, num_columns, num_rows, color_key=-1, has_alpha=False):
         super().__init__(img, color_key, has_alpha)
         self.rows = num_rows
         self.cols = num_columns
         self.img_width = self.sheet.get_width() // num_columns
         self.img_height = self.sheet.get_height() // num_rows
+        self.frames = tuple(
+            super(SpriteSheetGrid, self).get_image((c * self.img_width, r * self.img_height, self.img_width, self.img_height))
+            for r in range(num_rows) for c in range(num_columns)
+        )
+
+    def get_frame(self, col, row):
+        """ The image at column `col`, row `row`; no wrapping, no allocation """
+        return self.frames[row * self.cols + col]
 
     def get_image(self, rect):
         result = None
@@ -54,14 +62,9 @@ class SpriteSheetGrid(SpriteSheet):
         or (isinstance(rect, pygame.Rect)):
             result = super().get_image(rect)
         elif isinstance(rect, (list, tuple)) and len(rect) == 2:
-            x = (rect[0] % self.cols) * self.img_width
-            y = (rect[1] % self.rows) * self.img_height
-            result = super().get_image((x, y, self.img_width, self.img_height))
+            result = self.frames[(rect[1] % self.rows) * self.cols + rect[0] % self.cols]
         elif isinstance(rect, int):
-            rect %= self.cols * self.rows
-            x = (rect % self.cols) * self.img_width
-            y = (rect // self.cols) * self.img_height
-            result = super().get_image((x, y, self.img_width, self.img_height))
+            result = self.frames[rect % len(self.frames)]
         else:
             raise Exception("unknown coordinate", rect)
         return result
@@ -89,6 +92,18 @@ class SpriteSheetStrip(SpriteSheetGrid):
             raise Exception("SpriteSheetStrip constructor: invalid direction: " + direction)
 
 
+_grids = {}
+
+
+def load_grid(filename, num_columns, num_rows, color_key=-1, has_alpha=False):
+    """ Returns the SpriteSheetGrid for `filename`, loading it only the first time it is asked for """
+    key = (os.path.abspath(filename), num_columns, num_rows, color_key, has_alpha)
+    grid = _grids.get(key)
+    if grid is None:
+        grid = _grids[key] = SpriteSheetGrid(filename, num_columns, num_rows, color_key, has_alpha)
+    return grid
+
+
 def _convert_to_pygame_surface(obj) -> pygame.Surface:
     if isinstance(obj, pygame.Surface):
         return obj
@@ -1,5 +1,10 @@
-import pygame
-import pytmx
+import controls
+import time
+from collections import OrderedDict
+from fonts import fonts
+from audio import sounds
+from profiler import profiler
+from glob import glob
 from os import path
 from sprites import *
 from world import TiledMap
@@ -12,78 +17,282 @@ class State:
     def get_map(self):
         return None
 
+    def memory_size(self):
+        return 0
+
+    def unload(self):
+        pass
+
+    def enter(self):
+        """ Called when the game changes to this state """
+        pass
+
+    def invalidate(self, rects=None):
+        """ The whole screen, or just `rects`, must be redrawn on the next draw() """
+        pass
+
     def events(self):
         pass
 
     def update(self):
         pass
 
-    def draw(self):
+    def draw(self, alpha=1.0):
+        """ Draws the state `alpha` (0..1) of the way between the last two
+            simulation steps; returns the changed screen rects, or None if it all changed """
         pass
 
 
 class SplashState(State):
     def __init__(self, game):
         super().__init__(game)
-        self.screen = game.screen
-        self.title_font = pygame.font.SysFont("Arial", 55, True)
+        self.screen = game.renderer
+        self.title_font = ("Arial", 55, True)
         self.title_text = self.game.title.split(" ")
-        self.instr_font = pygame.font.SysFont("Ariel", 25)
+        self.instr_font = ("Ariel", 25, False)
         self.instr_text = "press any key to begin"
 
     def events(self):
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                self.game.quit()
-            elif event.type == pygame.KEYDOWN:
+        for kind, argument in self.game.input.poll():
+            if kind == controls.QUIT:
+                self.game.change_state(self.game.states['QUITTING'])
+                return
+
+    def update(self):
+        # on the step the key lands on, so that a replay starts the game on the same step
+        for kind, argument in self.game.input.released:
+            if kind == controls.KEY and profiler.handle_key(argument):
+                continue
+            if kind == controls.KEY and self.game.saves.handle_key(argument, saving=False):
+                return
+            if kind != controls.MOVE or argument:
+                # any key but a direction being let go
                 self.game.change_state(self.game.states['VILLAGE'])
+                return
 
-    def draw(self):
+    def draw(self, alpha=1.0):
         self.screen.fill(0)
         title_top = 10
         for text in self.title_text:
-            title = self.title_font.render(text, True, (228,155,15))
+            title = fonts.render(text, self.title_font, (228,155,15))
             self.screen.blit(title, (10,title_top))
             title_top += title.get_height() + 5
-        instruction = self.instr_font.render(self.instr_text, True, (255,255,255))
+        instruction = fonts.render(self.instr_text, self.instr_font, (255,255,255))
         instr_top = self.screen.get_height() - instruction.get_height() - 20
         self.screen.blit(instruction, (10, instr_top))
-        pygame.display.flip()
 
 
 class AdventureState(State):
-    def __init__(self, game, player, name, camera):
+    def __init__(self, game, player, name, camera, data=None):
         super().__init__(game)
         #
         # game world
         self.player = player
-        self.map = TiledMap(name, game, player)
-        self.tile_size = self.map.map.tilewidth
+        self.map = TiledMap(name, game, player, data)
+        self.tile_size = self.map.tile_size
         self.camera = camera
         self.messages = game.messages
         #
-        # music
-        pygame.mixer.music.load("./sfx/piano-loop.wav")
-        pygame.mixer.music.play(-1)
+        # what was on screen after the last draw, for dirty rectangles
+        self.redraw_all = True
+        self.drawn_camera = None
+        self.drawn_sprites = {}
+        self.drawn_message = None
+        self.damaged = []           # screen rects to redraw on top of whatever changed
 
     def get_map(self):
         return self.map
 
+    def memory_size(self):
+        return self.map.memory_size()
+
+    def unload(self):
+        self.map.unload()
+
+    def enter(self):
+        self.player.reindex((self.player.position.x, self.player.position.y, 1, 1))
+        # music, started here rather than on construction since maps may be built ahead of time
+        sounds.play_music(self.map.music)
+
+    def invalidate(self, rects=None):
+        if rects is None:
+            self.redraw_all = True
+        else:
+            self.damaged.extend(rects)
+
     def events(self):
-        for event in pygame.event.get():
-            if (event.type == pygame.QUIT) \
-            or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
-               self.game.change_state(self.game.states['QUITTING'])
+        for kind, argument in self.game.input.poll():
+            if kind == controls.QUIT:
+                self.game.change_state(self.game.states['QUITTING'])
+                return
 
     def update(self):
-        self.map.characters.update()
+        for kind, argument in self.game.input.released:
+            if kind == controls.KEY and not profiler.handle_key(argument):
+                self.game.saves.handle_key(argument)
+                if self.game.state is not self:
+                    return      # loaded a save
+        self.map.paths.update(self.player)
+        self.map.actors.update()
+        if self.map.crowd is not None:
+            self.map.crowd.update(player=self.player)
+        self.map.animations.update()
         self.messages.update()
-        self.camera.update(self.player)
 
-    def draw(self):
-        pygame.display.set_caption(self.game.title + " [{:.2f} FPS]".format(self.game.clock.get_fps()))
-        self.game.screen.blit(self.map.underfoot, self.camera.apply(self.map.underfoot.get_rect()))
+    def draw(self, alpha=1.0):
         for sprite in self.map.characters:
-            self.game.screen.blit(sprite.image, self.camera.apply(sprite))
-        self.game.screen.blit(self.map.overhead, self.camera.apply(self.map.overhead.get_rect()))
-        self.game.screen.blit(self.messages.image, self.messages.rect)
+            sprite.interpolate(alpha)
+        self.camera.update(self.player.render_rect)
+        if not self.game.dirty_rects:
+            self._draw_scene()
+            self.damaged = []
+            return None
+        #
+        # work out what moved or changed since the last frame
+        screen = self.game.renderer
+        camera = self.camera.camera.topleft
+        sprites = {sprite: (self.camera.apply(sprite.render_rect), sprite.image) for sprite in self.map.characters}
+        message = (self.messages.ticks, self.messages.image.get_alpha())
+        if self.redraw_all or camera != self.drawn_camera:
+            dirty = [screen.get_rect()]
+        else:
+            dirty = []
+            for sprite in set(sprites) | set(self.drawn_sprites):
+                now, before = sprites.get(sprite), self.drawn_sprites.get(sprite)
+                if now != before:
+                    rects = [r for r, _ in (now, before) if r is not None]
+                    dirty.append(rects[0].unionall(rects[1:]))
+            if message != self.drawn_message:
+                dirty.append(self.messages.rect)
+            dirty.extend(self.damaged)
+        #
+        # and redraw only those parts of the screen
+        for rect in dirty:
+            screen.set_clip(rect)
+            self._draw_scene()
+        screen.set_clip(None)
+        self.redraw_all = False
+        self.damaged = []
+        self.drawn_camera, self.drawn_sprites, self.drawn_message = camera, sprites, message
+        return dirty
+
+    def _draw_scene(self):
+        screen = self.game.renderer
+        self.map.underfoot.draw(screen, self.camera)
+        for sprite in self.map.characters:
+            screen.blit(sprite.image, self.camera.apply(sprite.render_rect))
+        self.map.overhead.draw(screen, self.camera)
+        # (the message box is drawn on, so it is uploaded again whenever the message changes)
+        screen.blit(self.messages.image, self.messages.rect, version=(self.messages.text, self.messages.ticks))
+
+
+class StateRegistry:
+    """ Builds game states the first time they are asked for, and keeps the
+        ones that are not in use in a least-recently-used cache that is
+        trimmed to stay under `memory_budget` bytes.  A map caches a screenful
+        of chunks and a ring round it, 2-4 MB at 500x500, so the default holds
+        the running map and one or two of the last ones visited. """
+
+    def __init__(self, game, memory_budget=8 * 1024 * 1024):
+        self.game = game
+        self.memory_budget = memory_budget
+        self.factories = {}
+        self.map_names = {}     # key -> map name, for the states of maps
+        self.states = OrderedDict()
+        self.build_times = {}
+        self.evictions = 0
+        self.listeners = []     # told when states are built or evicted, e.g. to restore saved data
+
+    def register(self, key, factory):
+        self.factories[key] = factory
+
+    def register_map(self, key, name):
+        self.map_names[key] = name
+        self.register(key, lambda: AdventureState(self.game, self.game.player, name, self.game.camera))
+
+    def register_maps(self, directory):
+        """ Registers every .tmx file in `directory` under its upper-cased name """
+        for filename in sorted(glob(path.join(directory, '*.tmx'))):
+            name = path.splitext(path.basename(filename))[0]
+            self.register_map(name.upper(), name)
+
+    def add(self, key, state):
+        """ Stores a state that was built elsewhere, e.g. by the preloader """
+        if key not in self.factories:
+            raise KeyError(key)
+        self.states[key] = state
+        self._built(key, state)
+        self._trim(keep=state)
+
+    def discard(self, key):
+        """ Unloads a state, if it is loaded, without telling the listeners """
+        state = self.states.pop(key, None)
+        if state is not None:
+            state.unload()
+
+    def key_of(self, state):
+        for key, loaded in self.states.items():
+            if loaded is state:
+                return key
+        return None
+
+    def __contains__(self, key):
+        return key in self.factories
+
+    def __getitem__(self, key):
+        if key not in self.factories:
+            raise KeyError(key)
+        if key in self.states:
+            self.states.move_to_end(key)
+        else:
+            started = time.perf_counter()
+            with profiler.scope('state build'):
+                self.states[key] = self.factories[key]()
+            self.build_times[key] = time.perf_counter() - started
+            print("built state {} in {:.1f} ms".format(key, self.build_times[key] * 1000))
+            self._built(key, self.states[key])
+        state = self.states[key]
+        self._trim(keep=state)
+        return state
+
+    def is_loaded(self, key):
+        return key in self.states
+
+    def memory_size(self):
+        return sum(s.memory_size() for s in self.states.values() if s is not None)
+
+    def _trim(self, keep):
+        # oldest first; never drop the state being handed out or the running one
+        for key in list(self.states):
+            if self.memory_size() <= self.memory_budget:
+                break
+            state = self.states[key]
+            if state is None or state is keep or state is self.game.state or not state.memory_size():
+                continue
+            size = state.memory_size()
+            del self.states[key]
+            for listener in self.listeners:
+                listener.state_evicted(key, state)
+            state.unload()
+            self.evictions += 1
+            print("evicted state {} ({:.1f} MB)".format(key, size / (1024 * 1024)))
+
+    def _built(self, key, state):
+        if state is not None:
+            for listener in self.listeners:
+                listener.state_built(key, state)
+
+    def report(self, startup_time=None):
+        """ Returns a short summary of what was built (and what startup cost, if
+            `startup_time` is given), what was deferred and the memory in use """
+        built = [k for k in self.build_times]
+        deferred = [k for k in self.factories if k not in self.build_times]
+        lines = ["startup took {:.1f} ms".format(startup_time * 1000)] if startup_time is not None else []
+        for key in built:
+            lines.append("  {:<12} {:8.1f} ms".format(key, self.build_times[key] * 1000))
+        if deferred:
+            lines.append("  deferred until first use: " + ", ".join(deferred))
+        lines.append("  {} of {} states loaded, {:.1f} of {:.1f} MB, {} evicted".format(
+            len(self.states), len(self.factories), self.memory_size() / (1024 * 1024),
+            self.memory_budget / (1024 * 1024), self.evictions))
+        return "\n".join(lines)
@@ -0,0 +1,90 @@
+import pygame
+import os
+import threading
+from pytmx.util_pygame import handle_transformation, smart_convert
+
+
+class TilesetManager:
+    """ Decodes each tileset image once per process and shares the tile
+        surfaces cut from it between every map that uses them """
+
+    def __init__(self):
+        self.atlases = {}       # (source, mtime) -> decoded tileset image
+        self.tiles = {}         # (source, mtime, rect, flags, colorkey) -> tile surface
+        self.scaled = {}        # (tile surface, size) -> scaled tile surface
+        self.decodes = 0
+        self.lock = threading.Lock()    # atlases may be decoded on a loader thread
+        self.scale_hits = 0
+        self.scale_misses = 0
+        self.scale_skips = 0
+
+    def get_tile(self, key, rect, flags, colorkey=None, pixelalpha=True):
+        tile_key = key + (rect, flags, None if colorkey is None else tuple(colorkey))
+        tile = self.tiles.get(tile_key)
+        if tile is None:
+            atlas = self.get_atlas(key)
+            tile = atlas.subsurface(rect) if rect else atlas.copy()
+            if flags:
+                tile = handle_transformation(tile, flags)
+            if pygame.display.get_surface() is not None:
+                tile = smart_convert(tile, colorkey, pixelalpha)
+            elif colorkey:
+                # no display to convert for, e.g. in a build worker: keep the image's own format
+                tile = tile.copy()
+                tile.set_colorkey(colorkey)
+            self.tiles[tile_key] = tile
+        return tile
+
+    def get_scaled(self, tile, size):
+        """ Returns `tile` scaled to `size`, scaling each shared tile only once """
+        if tile.get_size() == size:
+            self.scale_skips += 1
+            return tile
+        key = (tile, size)
+        result = self.scaled.get(key)
+        if result is None:
+            self.scale_misses += 1
+            result = pygame.transform.smoothscale(tile, size)
+            self.scaled[key] = result
+        else:
+            self.scale_hits += 1
+        return result
+
+    def counters(self):
+        # tiles that are subsurfaces share their atlas's pixels
+        surfaces = list(self.atlases.values()) + [t for t in self.tiles.values() if t.get_parent() is None] \
+            + list(self.scaled.values())
+        return {'decodes': self.decodes, 'tiles': len(self.tiles), 'scale_hits': self.scale_hits,
+                'scale_misses': self.scale_misses, 'scale_skips': self.scale_skips,
+                'kb': sum(s.get_bytesize() * s.get_width() * s.get_height() for s in surfaces) / 1024}
+
+    def stats(self):
+        return "tilesets: {decodes} decoded, {tiles} tiles, {kb:.0f} KB; " \
+               "scaling: {scale_hits} hits, {scale_misses} misses, {scale_skips} skipped".format(**self.counters())
+
+    def get_atlas(self, key):
+        atlas = self.atlases.get(key)
+        if atlas is None:
+            with self.lock:
+                atlas = self.atlases.get(key)
+                if atlas is None:
+                    self._forget(key[0])
+                    atlas = pygame.image.load(key[0])
+                    self.atlases[key] = atlas
+                    self.decodes += 1
+        return atlas
+
+    def atlas_key(self, filename):
+        source = os.path.abspath(filename)
+        return source, os.path.getmtime(source)
+
+    def _forget(self, source):
+        # the file changed on disk, so anything cut from the old copy is stale
+        for key in [k for k in self.atlases if k[0] == source]:
+            del self.atlases[key]
+        stale = [k for k in self.tiles if k[0] == source]
+        stale_tiles = set(self.tiles.pop(k) for k in stale)
+        self.scaled = {k: v for k, v in self.scaled.items() if k[0] not in stale_tiles}
+
+
+tilesets = TilesetManager()
@@ -1,78 +1,216 @@
 import pygame
 import pytmx
+import crowd
+import mapfile
+import sys
+from animation import Animator
+from chunks import CHUNK_TILES, ChunkedLayer, TileLayerSource, split_layers
 from os import path
+from encounters import EncounterMap
+from grid import CollisionGrid
+from paths import PathFinder
+from profiler import profiler
+from spatial import SpatialHash, tile_rect
+from audio import DEFAULT_MUSIC, SFX
 from sprites import *
+from tileset import tilesets
+from worlddata import world
+
+
+def map_filename(name):
+    return path.join(path.dirname(__file__), 'maps', name + '.tmx')
 
 
 class TiledMap:
-    def __init__(self, name, game, player=None):
-        filename = path.join(path.dirname(__file__), 'maps', name + '.tmx')
-        self.map = pytmx.load_pygame(filename, pixelAlpa=True)
-        self.width = self.map.width  # in tiles
-        self.height = self.map.height  # in tiles
+    def __init__(self, name, game, player=None, data=None, npcs=None):
+        self.name = name
         self.game = game
         self.tile_size = game.tile_size
         #
-        # sprite groups
+        # map data, from the compiled artifact unless it is missing or stale
+        if data is None:
+            data = load_map_data(name, self.tile_size)
+            if data.underfoot is None:
+                for _ in resolve_tiles(data):
+                    pass
+        self.width = data.width  # in tiles
+        self.height = data.height  # in tiles
+        self.layers = data.layers
+        self.music = path.join(SFX, data.music) if data.music else DEFAULT_MUSIC
+        self.grid = CollisionGrid(self.width, self.height, data.collision)
+        self.paths = PathFinder(self)
+        self.encounters = EncounterMap(self.width, self.height, self.layers, world.encounters_on(name), seed=name)
+        self.animations = Animator()
+        #
+        # sprite groups, and where their sprites are
         self.characters = pygame.sprite.Group()
-        self.obstacles = pygame.sprite.Group()
+        self.actors = pygame.sprite.Group()     # characters that update themselves, rather than in the crowd
         self.interacts = pygame.sprite.Group()
         self.exits = pygame.sprite.Group()
+        self.index = SpatialHash()
+        self.crowd = None
+        self.npcs = []
         if player is not None:
             self.characters.add(player)
+            self.actors.add(player)
+            self.index.insert(player, (player.position.x, player.position.y, 1, 1))
         #
         # messages
         self.messages = game.messages
         #
         # sprites
-        self._load_npcs(name)
-        self._load_exits()
+        self._load_npcs(world.npcs_on(name) if npcs is None else npcs)
+        self._load_exits(data.exits)
         #
-        # images
-        self.overhead, self.underfoot = self._render()
-
-    def _render(self):
-        w = self.width * self.tile_size.x
-        h = self.height * self.tile_size.y
-        top = pygame.Surface((w, h), pygame.SRCALPHA, 32).convert_alpha()
-        bottom = surface = pygame.Surface((w, h)).convert()
-        for layer in self.map.visible_layers:
-            if isinstance(layer, pytmx.TiledTileLayer):
-                self._draw_tile_layer(layer, surface)
+        # images, rendered in chunks as the camera reaches them
+        capacity = _chunk_capacity(game.screen.get_size(), self.tile_size)
+        self.underfoot = ChunkedLayer(data.underfoot, self.tile_size, capacity)
+        self.overhead = ChunkedLayer(data.overhead, self.tile_size, capacity)
+
+    def memory_size(self):
+        """ Approximate number of bytes the map holds: its rendered chunks, tile
+            layers, grids and distance fields (not the tiles it shares with other
+            maps, nor the pages of a memory-mapped artifact) """
+        layers = sum(sys.getsizeof(gids) for _, gids in self.layers if not isinstance(gids, memoryview))
+        return (self.underfoot.memory_size() + self.overhead.memory_size() + layers
+                + self.grid.memory_size() + self.encounters.memory_size() + self.paths.memory_size())
+
+    def unload(self):
+        """ Drops the sprites so the (shared) player does not keep this map alive """
+        for group in (self.characters, self.actors, self.interacts, self.exits):
+            group.empty()
+        self.crowd = None
+        self.index.clear()
+        self.animations.clear()
+
+    def entities_near(self, position, tiles, group=None):
+        """ Characters and exits within `tiles` tiles of `position`, optionally only those in `group` """
+        return self.index.near(position[0], position[1], tiles, group)
+
+    def exit_at(self, x, y):
+        exits = self.index.at(x, y, self.exits)
+        return exits[0] if exits else None
+
+    def _load_npcs(self, npcs):
+        self.npcs = [NPC(self, npc.name, Vector(npc.x, npc.y), npc.sprite, self.characters, self.interacts,
+                         npc_id=npc.id, script=npc.script)
+                     for npc in npcs]
+        together = [npc for npc in self.npcs if npc.script in crowd.SCRIPTS] if crowd.enabled else []
+        if together:
+            self.crowd = crowd.NPCCrowd(self, together)
+        self.actors.add([npc for npc in self.npcs if npc not in together])
+
+    def move_npc(self, npc, position, facing):
+        """ Puts a standing NPC straight onto another tile """
+        self.grid.release(npc.position)
+        self.grid.occupy(position)
+        npc.facing = facing
+        npc.place(position)
+        npc.image = npc.standing_image()
+        npc.path, npc.waiting = None, 0
+        if self.crowd is not None and npc not in self.actors:
+            self.crowd.place(npc)
+
+    def _load_exits(self, exits):
+        for (x, y, width, height, next_state, player_x, player_y) in exits:
+            exit = Exit(pygame.Rect(x, y, width, height), next_state, Vector(player_x, player_y), self.exits)
+            self.index.insert(exit, tile_rect(exit.rect, self.tile_size))
+
+
+def load_map_data(name, tile_size):
+    """ The compiled artifact for map `name` if it is up to date, else the
+        parsed .tmx, whose tiles still need resolve_tiles().  Needs no display. """
+    with profiler.scope('map data'):
+        filename = map_filename(name)
+        data = mapfile.load(filename, tile_size)
+        return data if data is not None else parse_tmx(filename, tile_size)
+
+
+def compile_tmx(filename, tile_size):
+    """ Parses a .tmx file and resolves its tiles into a CompiledMap """
+    data = parse_tmx(filename, tile_size)
+    for _ in resolve_tiles(data):
+        pass
+    return data
+
+
+def parse_tmx(filename, tile_size):
+    """ Reads everything but the tile images from a .tmx file, and decodes
+        the tileset images.  Needs no display, so it can run on any thread. """
+    tmx = pytmx.TiledMap(filename)
+    data = mapfile.CompiledMap(tmx.width, tmx.height, tile_size)
+    sources = [filename]
+    sources += [path.join(path.dirname(filename), ts.source) for ts in tmx.tilesets if ts.source]
+    data.sources = mapfile.source_stamps(*sources)
+    tiled_gids = _tiled_gids(tmx)
+    for layer in tmx.visible_layers:
+        if isinstance(layer, pytmx.TiledTileLayer):
+            gids = [tiled_gids.get(gid, 0) for row in layer.data for gid in row]
+            data.layers.append((layer.name, gids))
             if layer.name == 'collision':
-                surface = top
-        return top, bottom
-
-    def _draw_tile_layer(self, layer, surface):
-        img = self.map.get_tile_image_by_gid
-        for x, y, gid in layer:
-            tile = img(gid)
-            if tile:
-                tile = pygame.transform.smoothscale(tile, (int(self.tile_size.x), int(self.tile_size.y)))
-                surface.blit(tile, (x * self.tile_size.x, y * self.tile_size.y))
-                if layer.name == 'collision':
-                    Obstacle(self.game, Vector(x, y), self.obstacles)
-
-    def _load_npcs(self, map_name):
-        with open('npcs.txt') as f:
-            for line in f:
-                line = line.strip();
-                if line:
-                    (name, img, npc_map, x, y) = line.split(':')
-                    if map_name == npc_map:
-                        NPC(self, name, Vector(int(x), int(y)), img, self.characters, self.obstacles, self.interacts)
-
-    def _load_exits(self):
-        exits = self.map.get_layer_by_name('exits')
-        for x in exits:
-            print(x.x, x.y, x.width, x.height)  # these variables have the information needed to create the exit sprite's rect
-            print(x.properties)                 # these properties have the information needed to switch to the next map
-            next_state = x.properties['next_state']
-            player_x = int(x.properties['player_x'])
-            player_y = int(x.properties['player_y'])
-            groups = self.exits
-            exit = Exit(pygame.Rect(x.x, x.y, x.width, x.height), next_state, Vector(player_x, player_y,), groups)
+                data.collision = bytearray(1 if gid else 0 for gid in gids)
+    data.exits = _read_exits(tmx)
+    data.music = tmx.properties.get('music')
+    #
+    # without an image loader pytmx leaves (file, rect, flags) where the images would be
+    colorkeys = {path.join(path.dirname(filename), ts.source): ts.trans for ts in tmx.tilesets if ts.source}
+    for gid, image in enumerate(tmx.images):
+        if image and gid in tiled_gids:
+            source, rect, flags = image
+            key = tilesets.atlas_key(source)
+            tilesets.get_atlas(key)
+            data.tiles[tiled_gids[gid]] = (key, rect, flags if any(flags) else None, colorkeys.get(source))
+    return data
+
+
+def resolve_tiles(data):
+    """ Cuts, converts and scales the tiles `data` uses, then sets up its chunk
+        sources.  Yields after every tile, so the work can be spread over frames. """
+    size = data.tile_size
+    tiles = {}
+    for gid, (key, rect, flags, colorkey) in data.tiles.items():
+        if colorkey:
+            colorkey = pygame.Color("#{0}".format(colorkey))
+        tiles[gid] = tilesets.get_scaled(tilesets.get_tile(key, rect, flags, colorkey), size)
+        yield
+    data.tiles = tiles
+    under, over = split_layers(data.layers)
+    data.underfoot = TileLayerSource(under, data.width, data.height, tiles, size, alpha=False)
+    data.overhead = TileLayerSource(over, data.width, data.height, tiles, size, alpha=True)
+
+
+def _tiled_gids(tmx):
+    # pytmx renumbers tiles; map its GIDs back to the ones in the file, flip bits included
+    result = {}
+    for (tiled_gid, flags), value in tmx.imagemap.items():
+        if not tiled_gid:
+            continue
+        result[value[0]] = tiled_gid \
+            | (pytmx.pytmx.GID_TRANS_FLIPX if flags.flipped_horizontally else 0) \
+            | (pytmx.pytmx.GID_TRANS_FLIPY if flags.flipped_vertically else 0) \
+            | (pytmx.pytmx.GID_TRANS_ROT if flags.flipped_diagonally else 0)
+    return result
+
+
+def _read_exits(tmx):
+    try:
+        exits = tmx.get_layer_by_name('exits')
+    except ValueError:
+        return []
+    result = []
+    for x in exits:
+        next_state = x.properties['next_state']
+        player_x = int(x.properties['player_x'])
+        player_y = int(x.properties['player_y'])
+        result.append((x.x, x.y, x.width, x.height, next_state, player_x, player_y))
+    return result
+
 
+def _chunk_capacity(display_size, tile_size):
+    # enough chunks to cover the display plus a ring around it
+    columns = -(-display_size[0] // int(tile_size[0] * CHUNK_TILES)) + 2
+    rows = -(-display_size[1] // int(tile_size[1] * CHUNK_TILES)) + 2
+    return columns * rows
 
 
 class Camera:
@@ -94,8 +232,9 @@ class Camera:
 
     def update(self, target):
         if self.camera is not None:
-            x = -target.rect.centerx + int(self.display_width / 2)
-            y = -target.rect.centery + int(self.display_height / 2)
+            rect = target.rect if isinstance(target, pygame.sprite.Sprite) else target
+            x = -rect.centerx + int(self.display_width / 2)
+            y = -rect.centery + int(self.display_height / 2)
             #
             # don't scroll past the edge of the world in any direction
             x = min(0, x)  # left
@@ -0,0 +1,206 @@
+""" The world data store: every NPC's placement, sprite, dialogue and script,
+    and what hides in each map's encounter layers, in an SQLite database
+    indexed by map.  The database is compiled from the colon-separated text
+    files, and rebuilt when they change.
+
+    npcs.txt        name:sprite:map:x:y[:script]
+    dialogue.txt    name:map:line       (one row per line, shown in order)
+    encounters.txt  map:layer:creature:weight   (what hides in a map's encounter layers)
+
+    usage: python worlddata.py [--force]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+from os import path
+
+HERE = path.dirname(path.abspath(__file__))
+NPC_FILE = path.join(HERE, 'npcs.txt')
+DIALOGUE_FILE = path.join(HERE, 'dialogue.txt')
+ENCOUNTER_FILE = path.join(HERE, 'encounters.txt')
+DATABASE = path.join(HERE, 'world.db')
+SCHEMA_VERSION = 2
+
+_SCHEMA = """
+CREATE TABLE npcs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    sprite TEXT NOT NULL,
+    map TEXT NOT NULL,
+    x INTEGER NOT NULL,
+    y INTEGER NOT NULL,
+    script TEXT
+);
+CREATE INDEX npcs_by_map ON npcs (map);
+CREATE TABLE dialogue (
+    npc INTEGER NOT NULL REFERENCES npcs (id),
+    line INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (npc, line)
+);
+CREATE TABLE encounters (
+    map TEXT NOT NULL,
+    layer TEXT NOT NULL,
+    creature TEXT NOT NULL,
+    weight INTEGER NOT NULL
+);
+CREATE INDEX encounters_by_map ON encounters (map);
+"""
+
+
+class NPCRecord:
+    """ One row of the npcs table """
+
+    def __init__(self, id, name, sprite, map, x, y, script=None):
+        self.id = id
+        self.name = name
+        self.sprite = sprite
+        self.map = map
+        self.x = x
+        self.y = y
+        self.script = script
+
+
+class WorldData:
+    """ Opens the database the first time it is asked for anything, and caches
+        what it returns for each map """
+
+    def __init__(self, database=DATABASE, sources=(NPC_FILE, DIALOGUE_FILE, ENCOUNTER_FILE)):
+        self.database = database
+        self.sources = sources
+        self.connection = None
+        self.maps = {}      # map name -> [NPCRecord]
+        self.lines = {}     # NPC id -> [dialogue line]
+        self.spawns = {}    # map name -> {layer: [(creature, weight)]}
+
+    def npcs_on(self, map_name):
+        npcs = self.maps.get(map_name)
+        if npcs is None:
+            rows = self._connect().execute(
+                "SELECT id, name, sprite, map, x, y, script FROM npcs WHERE map = ? ORDER BY id", (map_name,))
+            npcs = self.maps[map_name] = [NPCRecord(*row) for row in rows]
+        return npcs
+
+    def dialogue(self, npc_id):
+        lines = self.lines.get(npc_id)
+        if lines is None:
+            rows = self._connect().execute("SELECT text FROM dialogue WHERE npc = ? ORDER BY line", (npc_id,))
+            lines = self.lines[npc_id] = [text for (text,) in rows]
+        return lines
+
+    def encounters_on(self, map_name):
+        tables = self.spawns.get(map_name)
+        if tables is None:
+            rows = self._connect().execute(
+                "SELECT layer, creature, weight FROM encounters WHERE map = ? ORDER BY rowid", (map_name,))
+            tables = self.spawns[map_name] = {}
+            for layer, creature, weight in rows:
+                tables.setdefault(layer, []).append((creature, weight))
+        return tables
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = None
+        self.maps.clear()
+        self.lines.clear()
+        self.spawns.clear()
+
+    def _connect(self):
+        if self.connection is None:
+            if not is_current(self.database, self.sources):
+                print("converting {} into {}".format(", ".join(path.basename(s) for s in self.sources),
+                                                     path.basename(self.database)))
+                convert(self.database, *self.sources)
+            self.connection = sqlite3.connect(self.database)
+        return self.connection
+
+
+def is_current(database, sources):
+    """ True if `database` has the current schema and is newer than all of its (existing) sources """
+    try:
+        built = os.stat(database).st_mtime_ns
+        connection = sqlite3.connect(database)
+        try:
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+        finally:
+            connection.close()
+    except (OSError, sqlite3.Error):
+        return False
+    return version == SCHEMA_VERSION and all(os.stat(s).st_mtime_ns <= built for s in sources if path.exists(s))
+
+
+def convert(database, npc_file=NPC_FILE, dialogue_file=DIALOGUE_FILE, encounter_file=ENCOUNTER_FILE):
+    """ Builds `database` from the text files, replacing it in one step """
+    temporary = database + '.tmp'
+    if path.exists(temporary):
+        os.remove(temporary)
+    connection = sqlite3.connect(temporary)
+    try:
+        connection.executescript(_SCHEMA)
+        ids = {}
+        for fields in _read_rows(npc_file):
+            name, sprite, map_name, x, y = fields[:5]
+            script = fields[5] if len(fields) > 5 and fields[5] else None
+            cursor = connection.execute("INSERT INTO npcs (name, sprite, map, x, y, script) VALUES (?, ?, ?, ?, ?, ?)",
+                                        (name, sprite, map_name, int(x), int(y), script))
+            ids.setdefault((name, map_name), cursor.lastrowid)
+        counts = {}
+        if path.exists(dialogue_file):
+            for fields in _read_rows(dialogue_file):
+                # the line itself may contain colons
+                name, map_name, text = fields[0], fields[1], ':'.join(fields[2:])
+                npc = ids.get((name, map_name))
+                if npc is None:
+                    raise ValueError("dialogue for unknown NPC {} on {}".format(name, map_name))
+                counts[npc] = counts.get(npc, 0) + 1
+                connection.execute("INSERT INTO dialogue (npc, line, text) VALUES (?, ?, ?)",
+                                   (npc, counts[npc], text))
+        if path.exists(encounter_file):
+            for map_name, layer, creature, weight in _read_rows(encounter_file):
+                if int(weight) <= 0:
+                    raise ValueError("{} on {} needs a positive weight".format(creature, map_name))
+                connection.execute("INSERT INTO encounters (map, layer, creature, weight) VALUES (?, ?, ?, ?)",
+                                   (map_name, layer, creature, int(weight)))
+        connection.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(temporary, database)
+    return database
+
+
+def _read_rows(filename):
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line.split(':')
+
+
+# shared by every map
+world = WorldData()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="convert the NPC text files into the world database")
+    parser.add_argument('--force', '-f', action='store_true', help="rebuild an up to date database too")
+    args = parser.parse_args(argv)
+    if not args.force and is_current(DATABASE, (NPC_FILE, DIALOGUE_FILE, ENCOUNTER_FILE)):
+        print("{} is up to date".format(path.basename(DATABASE)))
+        return 0
+    convert(DATABASE)
+    connection = sqlite3.connect(DATABASE)
+    try:
+        npcs, lines, spawns = (connection.execute("SELECT COUNT(*) FROM " + table).fetchone()[0]
+                               for table in ('npcs', 'dialogue', 'encounters'))
+    finally:
+        connection.close()
+    print("{}: {} NPCs, {} lines of dialogue, {} encounter entries".format(
+        path.basename(DATABASE), npcs, lines, spawns))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))